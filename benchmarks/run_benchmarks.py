@@ -0,0 +1,322 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+End to end benchmarks of the segmentation and registration stages.
+Segmentation runs on synthetic frames (synthetic.py), registration on the bundled simple geometric model
+(raw_segmented_points.csv and ground_truth_in_stl_form.stl).
+Reports the latency percentiles of every stage, frames per second and peak memory, and saves the results as
+json in benchmarks/results so the next run can be compared against them.
+The stages are timed with tracemalloc off (it slows the numpy heavy stages down about 2x) and their memory is
+measured in a second pass with it on.
+
+Example: python benchmarks/run_benchmarks.py --frames 200 --fail-on-regression
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from timeit import default_timer as timer
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.append(ROOT)
+
+from synthetic import make_sweep
+from segmentation.singleprobjump import get_prob_map, get_highly_likely_points
+from segmentation.get_prob_map_v2 import ProbMapEngine
+from segmentation.find_best_path_jumping import find_best_path_jumping, MultiScalePathFinder, PathFinder
+from segmentation.overlay import render_overlay
+from registration.calibration import calibrate, load_raw_points
+from registration.error_map import get_errors, get_surface_errors, get_field_errors
+from registration.stl_cache import load_ground_truth
+
+MODEL_DIR = os.path.join(ROOT, "registration", "simple geometric model")
+RESULTS_DIR = os.path.join(HERE, "results")
+
+# Fresh interpreter runs timed by bench_startup: importing the package modules a short per scan task needs,
+# and the --help of every console entry point (which imports its module but does no work)
+STARTUP = {
+    "startup_python": ["-c", "pass"],
+    "startup_import_segmentation": ["-c", "import segmentation.singleprobjump"],
+    "startup_import_registration": ["-c", "import registration.calibration, registration.stl_cache, "
+                                          "registration.error_map"],
+    "startup_segment_help": ["-m", "segmentation.singleprobjump", "--help"],
+    "startup_points_help": ["-m", "segmentation.point_file", "--help"],
+    "startup_register_help": ["-m", "registration.batch_registration", "--help"],
+}
+
+
+# tracemalloc.reset_peak needs Python 3.9, older versions restart the tracing instead, which also forgets what
+# was allocated before (the group peaks then leave it out, the stage peaks are the same)
+def reset_peak():
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+# Collects the latency of every call of every stage. With memory (tracemalloc must be running) it also
+# collects the most a call of every stage allocated on top of what was allocated when it started, and the
+# peak traced memory of all the calls (top).
+class Timings:
+
+    def __init__(self, memory=False):
+        self.samples = {}
+        self.memory = memory
+        self.peaks = {}
+        self.top = 0
+
+    def time(self, stage, function, *args, **kwargs):
+        if self.memory:
+            reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = timer()
+        result = function(*args, **kwargs)
+        self.samples.setdefault(stage, []).append(timer() - start)
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peaks[stage] = max(self.peaks.get(stage, 0), peak - before)
+            self.top = max(self.top, peak)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.samples.items():
+            ms = np.array(samples) * 1000
+            summary[stage] = dict(calls=len(ms), mean_ms=ms.mean(), p50_ms=np.percentile(ms, 50),
+                                  p90_ms=np.percentile(ms, 90), p99_ms=np.percentile(ms, 99), max_ms=ms.max())
+        return summary
+
+
+# Mean distance (pixels of the crop) from a path to the synthetic bone surface, scale is the size of the crop over
+# the size of the prob map the path was found on
+def path_error(path, surface, scale=1):
+    columns = np.minimum(np.arange(len(surface)) // scale, len(path) - 1).astype(np.intp)
+    return np.mean(np.abs((path[columns] + 0.5) * scale - 0.5 - surface))
+
+
+# Segmentation stages on synthetic frames. Returns the frames per second of prob map + DP + points, and the mean
+# path error against the synthetic surface of the half size search and of the full resolution refinement.
+def bench_segmentation(timings, n_frames, batch):
+    sweep = list(make_sweep(n_frames))
+    frames = [frame for frame, surface in sweep]
+    engine = ProbMapEngine(frames[0].shape)
+    # not timed: the first call imports skimage
+    get_prob_map(frames[0])
+
+    start = timer()
+    half_size_error = []
+    for count, gray in enumerate(frames, 1):
+        prob_map = timings.time("prob_map_engine", engine, gray)
+        [a, b] = np.shape(prob_map)
+        cost, nexts, path = timings.time("dp", find_best_path_jumping, 0.5 - prob_map, 50, a // 2, nexts=False)
+        timings.time("points", get_highly_likely_points, prob_map[np.newaxis], path[np.newaxis], count)
+        half_size_error.append(path_error(path, sweep[count - 1][1], 2))
+    fps = n_frames / (timer() - start)
+
+    # coarse to fine path search, on the half size prob map and refined to the full size crop. The full resolution
+    # prob map is an approximation (see ProbMapEngine.full_resolution), checked by the path error against the
+    # synthetic surface
+    multi_scale = MultiScalePathFinder(levels=1)
+    full_resolution = MultiScalePathFinder(levels=2)
+    full_resolution_error = []
+    for gray, surface in sweep:
+        prob_map = engine(gray)
+        [a, b] = np.shape(prob_map)
+        timings.time("dp_multi_scale", multi_scale, 0.5 - prob_map, a // 2)
+        full = timings.time("prob_map_full_resolution", engine.full_resolution)
+        cost, nexts, full_path = timings.time("dp_full_resolution", full_resolution, 0.5 - full,
+                                              np.shape(full)[0] // 2)
+        full_resolution_error.append(path_error(full_path, surface))
+
+    # the optional overlay of the last frame, not part of the frames per second
+    for repeat in range(10):
+        timings.time("overlay", render_overlay, prob_map, path)
+
+    # the reference (allocating, float64) prob map and the batched DP
+    prob_maps = np.stack([timings.time("get_prob_map", get_prob_map, gray) for gray in frames])
+    path_finder = PathFinder(max_jump=50, nexts=False)
+    for first in range(0, n_frames, batch):
+        stack = 0.5 - prob_maps[first:first + batch]
+        timings.time(f"dp_batch_{batch}", path_finder, stack)
+
+    return fps, dict(half_size=np.mean(half_size_error), full_resolution=np.mean(full_resolution_error))
+
+
+# Registration stages on the bundled simple geometric model
+def bench_registration(timings, repeats):
+    # not timed: the first call imports pandas
+    load_raw_points(os.path.join(MODEL_DIR, "raw_segmented_points.csv"))
+    raw = timings.time("load_raw_points", load_raw_points, os.path.join(MODEL_DIR, "raw_segmented_points.csv"))
+    stl_path = os.path.join(MODEL_DIR, "ground_truth_in_stl_form.stl")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ground_truth = timings.time("stl_cache_build", load_ground_truth, stl_path, cache_dir)
+        for repeat in range(repeats):
+            ground_truth = timings.time("stl_cache_load", load_ground_truth, stl_path, cache_dir)
+            timings.time("tree_build", lambda: ground_truth.tree)
+            segmented_points = timings.time("calibrate", calibrate, raw)
+            timings.time("error", get_errors, segmented_points, None, 1 / 100, tree=ground_truth.tree)
+        timings.time("bvh_build", lambda: ground_truth.mesh_distance)
+        for repeat in range(repeats):
+            timings.time("surface_error", get_surface_errors, segmented_points, ground_truth.mesh_distance)
+        field = timings.time("field_build", ground_truth.distance_field)
+        for repeat in range(repeats):
+            timings.time("field_error", get_field_errors, segmented_points, field)
+
+        try:
+            import open3d
+            from registration.point_clouds import make_point_cloud
+            from registration.icp import pyramid_icp, register_model
+        except ImportError as e:
+            print(f"Skipping the ICP stages, open3d could not be imported ({e})")
+            return
+
+        source = make_point_cloud(ground_truth.vertices, normals=ground_truth.vertex_normals)
+        target = make_point_cloud(segmented_points)
+        for repeat in range(repeats):
+            timings.time("icp", open3d.registration.registration_icp, source, target, 0.005, np.identity(4))
+            timings.time("icp_pyramid", pyramid_icp, source, target)
+
+        # point to point against point to plane (STL normals), both stepped so their iterations are counted
+        for mode, point_to_plane in [("icp_point", False), ("icp_plane", True)]:
+            for repeat in range(repeats):
+                transformation, report = timings.time(f"{mode}_counted", register_model, source, target, 0.005,
+                                                      point_to_plane=point_to_plane)
+            print(f"{mode}: {report['iterations']} iterations, fitness {report['fitness']:.4f}, "
+                  f"rmse {report['inlier_rmse']:.4f}")
+
+
+# Traced memory of the stage groups, run again with tracemalloc on. Returns the peak traced memory (MB) of every
+# group and the most a call of every stage allocated on top of what was already allocated (MB)
+def bench_memory(n_frames, batch, repeats):
+    groups, stages = {}, {}
+    tracemalloc.start()
+    try:
+        for group, bench, args in [("segmentation", bench_segmentation, (n_frames, batch)),
+                                   ("registration", bench_registration, (repeats,))]:
+            memory = Timings(memory=True)
+            reset_peak()
+            bench(memory, *args)
+            groups[group] = max(memory.top, tracemalloc.get_traced_memory()[1]) / (1 << 20)
+            stages.update((stage, peak / (1 << 20)) for stage, peak in memory.peaks.items())
+    finally:
+        tracemalloc.stop()
+
+    return groups, stages
+
+
+# Cold start of the entry points, every repeat in a new interpreter
+def bench_startup(timings, repeats):
+    for stage, args in STARTUP.items():
+        for repeat in range(repeats):
+            timings.time(stage, subprocess.run, [sys.executable] + args, cwd=ROOT, check=True,
+                         stdout=subprocess.DEVNULL)
+
+
+# Startup stages whose median is over budget_ms
+def find_over_budget(stages, budget_ms):
+    return [(stage, s["p50_ms"]) for stage, s in stages.items()
+            if stage in STARTUP and stage != "startup_python" and s["p50_ms"] > budget_ms]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Stages whose median got slower than the previous results by more than tolerance (a fraction)
+def find_regressions(stages, previous, tolerance):
+    regressions = []
+    for stage, now in stages.items():
+        before = previous["stages"].get(stage)
+        if before is not None and now["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append((stage, before["p50_ms"], now["p50_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the segmentation and registration stages")
+    parser.add_argument("--frames", type=int, default=100, help="number of synthetic frames")
+    parser.add_argument("--batch", type=int, default=50, help="frames per batch for the batched DP")
+    parser.add_argument("--repeats", type=int, default=10, help="repeats of the registration stages")
+    parser.add_argument("--baseline", default=None, help="results json to compare with (default: latest saved)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown of a stage median")
+    parser.add_argument("--no-save", action="store_true", help="do not save the results")
+    parser.add_argument("--startup-repeats", type=int, default=5, help="interpreter starts per entry point")
+    parser.add_argument("--startup-budget", type=float, default=500, help="allowed median startup time (ms)")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="exit with 1 if any stage regressed or an entry point is over the startup budget")
+    args = parser.parse_args()
+
+    timings = Timings()
+    fps, path_errors = bench_segmentation(timings, args.frames, args.batch)
+    bench_registration(timings, args.repeats)
+    bench_startup(timings, args.startup_repeats)
+    group_peaks, stage_peaks = bench_memory(args.frames, args.batch, 1)
+
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / (1 << 20) if sys.platform == "darwin" else max_rss / 1024
+
+    stages = timings.summary()
+    for stage, peak in stage_peaks.items():
+        stages[stage]["peak_mb"] = peak
+    results = dict(revision=git_revision(), time=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                   numpy=np.__version__, machine=platform.machine(), frames=args.frames, frames_per_second=fps,
+                   path_error_px=path_errors, peak_traced_mb=group_peaks, max_rss_mb=max_rss_mb, stages=stages)
+
+    print(f"{'stage':<28} {'calls':>6} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9}  (ms) {'peak':>8} (MB)")
+    for stage, s in stages.items():
+        peak = f"{s['peak_mb']:>8.1f}" if "peak_mb" in s else f"{'':>8}"
+        print(f"{stage:<28} {s['calls']:>6d} {s['mean_ms']:>9.3f} {s['p50_ms']:>9.3f} {s['p90_ms']:>9.3f} "
+              f"{s['p99_ms']:>9.3f}       {peak}")
+    print(f"Segmentation: {fps:.1f} frames/s")
+    print("Path error against the synthetic surface: " +
+          ", ".join(f"{mode} {error:.2f} px" for mode, error in path_errors.items()))
+    print("Peak memory: " + ", ".join(f"{group} {mb:.1f} MB traced" for group, mb in group_peaks.items()) +
+          f", {max_rss_mb:.1f} MB max RSS")
+
+    baseline = args.baseline
+    if baseline is None:
+        saved = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+        baseline = saved[-1] if saved else None
+
+    regressions = []
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = find_regressions(stages, json.load(f), args.tolerance)
+        print(f"Compared with {os.path.basename(baseline)}: {len(regressions)} regression(s)")
+        for stage, before, now in regressions:
+            print(f"  {stage}: {before:.3f} ms -> {now:.3f} ms")
+
+    over_budget = find_over_budget(stages, args.startup_budget)
+    print(f"Startup budget {args.startup_budget:g} ms: {len(over_budget)} entry point(s) over")
+    for stage, p50 in over_budget:
+        print(f"  {stage}: {p50:.1f} ms")
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{results['revision']}.json"
+        with open(os.path.join(RESULTS_DIR, name), "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results/{name}")
+
+    if (regressions or over_budget) and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Synthetic ultrasound frames for the benchmarks, at the size of the real crop (img[80:400, 270:850]).
+Each frame has speckled soft tissue, a bright curved bone surface and the acoustic shadow underneath it.
+"""
+
+import numpy as np
+
+CROP_SHAPE = (320, 580)
+
+
+# One grayscale frame (uint8) and the row of the bone surface in every column.
+# phase moves the curve along, so consecutive phases look like consecutive frames of a sweep.
+def make_frame(rng, shape=CROP_SHAPE, phase=0.0):
+    [rows, cols] = shape
+    x = np.arange(cols)
+    surface = rows * 0.45 + rows * 0.12 * np.sin(3 * np.pi * x / cols + phase)
+
+    depth = np.arange(rows)[:, np.newaxis] - surface[np.newaxis, :]
+
+    # soft tissue fading with depth, a thin bright bone line and a dark shadow below it
+    tissue = 60 * np.exp(-np.arange(rows) / rows)[:, np.newaxis]
+    bone = 200 * np.exp(-0.5 * (depth / 2.5) ** 2)
+    shadow = np.where(depth > 4, 0.15, 1.0)
+
+    # multiplicative speckle
+    speckle = rng.rayleigh(scale=0.8, size=shape)
+    frame = (tissue * shadow + bone) * speckle
+
+    return np.clip(frame, 0, 255).astype(np.uint8), surface
+
+
+# n_frames consecutive frames of a sweep, yielded one at a time
+def make_sweep(n_frames, shape=CROP_SHAPE, seed=0, phase_step=0.02):
+    rng = np.random.default_rng(seed)
+    for frame in range(n_frames):
+        yield make_frame(rng, shape, frame * phase_step)
@@ -0,0 +1,4 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Instrumentation shared by the segmentation and registration packages (metrics.py), which depends on neither.
+"""
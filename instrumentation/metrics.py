@@ -0,0 +1,195 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Lightweight instrumentation shared by the segmentation and registration code.
+Stages are wrapped in named spans (with metrics.span("dp", frame=count): ...) and every finished span is
+handed to the sinks that are installed. With no sinks installed span() returns a shared do nothing context,
+so the instrumentation can stay in the hot loops.
+
+Sinks: LogSink (one structured log line per span), Registry (counters and histograms kept in the process)
+and ProfileSink (cProfile of every span of a single frame).
+Sinks are per process, spans of pool workers only reach sinks installed in the workers.
+"""
+
+import cProfile
+import contextlib
+import io
+import logging
+import math
+import pstats
+from timeit import default_timer as timer
+
+# Installed sinks, see install()
+sinks = []
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+# Times the block and reports it to every sink as name, seconds and the extra fields (frame=..., etc)
+class Span:
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        for sink in sinks:
+            sink.start(self.name, self.fields)
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = timer() - self.start
+        for sink in sinks:
+            sink.finish(self.name, seconds, self.fields)
+        return False
+
+
+def span(name, **fields):
+    if not sinks:
+        return NULL_SPAN
+    return Span(name, fields)
+
+
+# Adds value to the counter called name in every sink
+def count(name, value=1):
+    for sink in sinks:
+        sink.count(name, value)
+
+
+def install(sink):
+    sinks.append(sink)
+    return sink
+
+
+def uninstall(sink):
+    sinks.remove(sink)
+
+
+# Base class of the sinks, a sink only needs to override the hooks it cares about
+class Sink:
+
+    def start(self, name, fields):
+        pass
+
+    def finish(self, name, seconds, fields):
+        pass
+
+    def count(self, name, value):
+        pass
+
+
+# One key=value log line per finished span and per counter update
+class LogSink(Sink):
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger("metrics")
+        self.level = level
+
+    def finish(self, name, seconds, fields):
+        if self.logger.isEnabledFor(self.level):
+            extra = "".join(f" {key}={value}" for key, value in fields.items())
+            self.logger.log(self.level, f"span={name} ms={seconds * 1000:.3f}{extra}")
+
+    def count(self, name, value):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, f"counter={name} value={value}")
+
+
+# Histogram of durations in log spaced buckets (BUCKETS_PER_DECADE per factor of 10, from 1 us up),
+# so memory stays fixed however many spans are recorded. Percentiles are read off the buckets.
+class Histogram:
+    BUCKETS_PER_DECADE = 20
+    MIN_SECONDS = 1e-6
+
+    def __init__(self):
+        self.buckets = {}
+        self.calls = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = math.floor(math.log10(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS) * self.BUCKETS_PER_DECADE)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.calls += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    # Upper edge of the bucket holding the q-th percentile, clipped to the largest value seen
+    def percentile(self, q):
+        rank = q / 100 * self.calls
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.MIN_SECONDS * 10 ** ((bucket + 1) / self.BUCKETS_PER_DECADE), self.max)
+        return self.max
+
+
+# Counters and span histograms kept in the process
+class Registry(Sink):
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def finish(self, name, seconds, fields):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        spans = {name: dict(calls=h.calls, total_s=h.total, mean_ms=h.total / h.calls * 1000,
+                            p50_ms=h.percentile(50) * 1000, p95_ms=h.percentile(95) * 1000,
+                            max_ms=h.max * 1000)
+                 for name, h in self.histograms.items()}
+        return dict(spans=spans, counters=dict(self.counters))
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{'span':<16} {'calls':>7} {'total (s)':>10} {'mean':>9} {'p50':>9} {'p95':>9} {'max':>9}  (ms)")
+        for name, s in sorted(summary["spans"].items(), key=lambda item: -item[1]["total_s"]):
+            print(f"{name:<16} {s['calls']:>7d} {s['total_s']:>10.3f} {s['mean_ms']:>9.3f} {s['p50_ms']:>9.3f} "
+                  f"{s['p95_ms']:>9.3f} {s['max_ms']:>9.3f}")
+        for name, value in summary["counters"].items():
+            print(f"{name:<16} {value:>7}")
+
+
+# cProfile of every span whose frame field is frame, i.e. everything one frame goes through.
+# The stages of a frame run interleaved with other frames in the pipeline, so the profiler is switched on
+# and off around each of its spans and the stats add up. Nested spans only switch it off at the outermost.
+class ProfileSink(Sink):
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.profiler = cProfile.Profile()
+        self.depth = 0
+        self.seen = False
+
+    def start(self, name, fields):
+        if fields.get("frame") == self.frame:
+            if self.depth == 0:
+                self.profiler.enable()
+            self.depth += 1
+            self.seen = True
+
+    def finish(self, name, seconds, fields):
+        if fields.get("frame") == self.frame:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
+
+    # Saves the stats for pstats/snakeviz if path is given, and returns the top entries as text
+    def report(self, path=None, sort="cumulative", limit=25):
+        if not self.seen:
+            return f"Frame {self.frame} was never seen, nothing was profiled"
+        if path is not None:
+            self.profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
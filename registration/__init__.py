@@ -0,0 +1,46 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Registration of the segmented points with the ground truth STL model, and the error between them.
+The public names below are imported from their modules the first time they are used, so the modules that need
+open3d (icp, point_clouds, online_registration) are only loaded by the code that runs ICP.
+"""
+
+import importlib
+
+# public name -> module of this package it lives in
+EXPORTS = {
+    "AffineTransform": "calibration",
+    "ImageToWorld": "calibration",
+    "calibrate": "calibration",
+    "load_raw_points": "calibration",
+    "get_errors": "error_map",
+    "get_surface_errors": "error_map",
+    "get_field_errors": "error_map",
+    "get_error_colours": "error_map",
+    "GroundTruth": "stl_cache",
+    "load_ground_truth": "stl_cache",
+    "MeshDistance": "mesh_distance",
+    "DistanceField": "distance_field",
+    "build_distance_field": "distance_field",
+    "make_point_cloud": "point_clouds",
+    "pyramid_icp": "icp",
+    "pyramid_levels": "icp",
+    "register_model": "icp",
+    "OnlineRegistration": "online_registration",
+    "register_scans": "batch_registration",
+}
+
+__all__ = list(EXPORTS)
+
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(f".{EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(EXPORTS))
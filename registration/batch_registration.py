@@ -0,0 +1,162 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Headless batch registration of many segmented scans against one ground truth model.
+Input: 1. The ground truth model in STL format
+       2. Any number of segmented points csv files
+Output: One row per scan (transformation, fitness and error statistics) as a csv table
+
+Example: ultrasound-register ground_truth.stl scans/*.csv --workers 8 --output results.csv
+(or python -m registration.batch_registration from the repository root)
+"""
+
+import argparse
+import csv
+import logging
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+
+from instrumentation import metrics
+
+from .calibration import calibrate, load_raw_points
+from .error_map import get_errors, get_surface_errors, get_field_errors
+from .stl_cache import load_ground_truth
+
+COLUMNS = ["scan", "points", "fitness", "inlier_rmse", "iterations", "error_mean", "error_median", "error_p95",
+           "error_max", "seconds"] + [f"t{i}{j}" for i in range(4) for j in range(4)]
+
+# ICP correspondence distance of a single pass when none is given
+THRESHOLD = 0.005
+
+# Target structures of the worker process, built once by init_worker and used for every scan it registers
+target = {}
+
+
+# Loads the ground truth from the cache (memory mapped, so every worker shares the same pages)
+# and builds its KD-tree and point cloud once per process. log_spans logs the time of every stage of every scan.
+# open3d is only imported by the worker processes, the main process just builds the cache.
+def init_worker(stl_path, cache_dir=None, log_spans=False):
+    from .point_clouds import make_point_cloud
+
+    if log_spans:
+        logging.basicConfig(level=logging.INFO, format="%(process)d %(message)s")
+        metrics.install(metrics.LogSink())
+
+    with metrics.span("stl_load"):
+        ground_truth = load_ground_truth(stl_path, cache_dir)
+        target["ground_truth"] = ground_truth
+        target["tree"] = ground_truth.tree
+        target["cloud"] = make_point_cloud(ground_truth.vertices, normals=ground_truth.vertex_normals)
+
+
+# Registers one scan, the same steps as registration() of the scripts without any of the plots.
+# The errors are the distances (mm) from the segmented points, moved onto the model by the registration,
+# to the nearest ground truth vertex, or with surface_error to the nearest point on its triangles, or with
+# field_voxel looked up in the precomputed distance field of that voxel size (mm).
+# point_to_plane uses point to plane ICP against the STL normals, and is the only mode that counts its iterations.
+# threshold is the ICP correspondence distance (THRESHOLD if None). With pyramid it is the distance of the finest
+# level and the coarser levels scale with it (see pyramid_levels), None keeps PYRAMID_LEVELS as they are.
+def register_scan(path, threshold=None, pyramid=False, point_to_plane=False, surface_error=False, field_voxel=None):
+    import open3d
+    from .icp import pyramid_icp, pyramid_levels, register_model
+    from .point_clouds import make_point_cloud
+
+    start = timer()
+    with metrics.span("load_points", scan=path):
+        segmented_points = calibrate(load_raw_points(path), copy=False)
+        segmented_cloud = make_point_cloud(segmented_points)
+
+    # the ground truth is registered onto the segmented points, as in the scripts
+    trans_init = np.identity(4)
+    distance = THRESHOLD if threshold is None else threshold
+    estimation = open3d.registration.TransformationEstimationPointToPoint()
+    with metrics.span("icp", scan=path):
+        if point_to_plane:
+            transformation, report = register_model(target["cloud"], segmented_cloud, distance, trans_init,
+                                                    point_to_plane=True)
+        else:
+            if pyramid:
+                result, levels = pyramid_icp(target["cloud"], segmented_cloud, trans_init, pyramid_levels(threshold),
+                                             estimation)
+            else:
+                result = open3d.registration.registration_icp(target["cloud"], segmented_cloud, distance,
+                                                              trans_init, estimation)
+            transformation = np.asarray(result.transformation)
+            report = dict(iterations=None, fitness=result.fitness, inlier_rmse=result.inlier_rmse)
+
+    # move the segmented points back into the model coordinates to measure them
+    inverse = np.linalg.inv(transformation)
+    registered = segmented_points @ inverse[:3, :3].T + inverse[:3, 3]
+    with metrics.span("error", scan=path):
+        if field_voxel is not None:
+            error = get_field_errors(registered, target["ground_truth"].distance_field(field_voxel), max_error=np.inf)
+        elif surface_error:
+            mesh = target["ground_truth"].mesh_distance
+            error, nearest = get_surface_errors(registered, mesh, max_error=np.inf, workers=1)
+        else:
+            error, nearest = get_errors(registered, None, max_error=np.inf, tree=target["tree"], workers=1)
+
+    row = dict(scan=path, points=len(segmented_points), fitness=report["fitness"],
+               inlier_rmse=report["inlier_rmse"], iterations=report["iterations"], error_mean=np.mean(error),
+               error_median=np.median(error), error_p95=np.percentile(error, 95), error_max=np.max(error),
+               seconds=timer() - start)
+    for i in range(4):
+        for j in range(4):
+            row[f"t{i}{j}"] = transformation[i, j]
+
+    return row
+
+
+# Registers every scan on a pool of worker processes and yields the result rows in the order of scans.
+# The cache is built here first, so the workers only ever memory map it.
+def register_scans(stl_path, scans, workers=1, threshold=None, pyramid=False, cache_dir=None, log_spans=False,
+                   point_to_plane=False, surface_error=False, field_voxel=None):
+    ground_truth = load_ground_truth(stl_path, cache_dir)
+    if surface_error:
+        ground_truth.mesh_distance
+    if field_voxel is not None:
+        ground_truth.distance_field(field_voxel)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(stl_path, cache_dir, log_spans)) as pool:
+        yield from pool.map(register_scan, scans, [threshold] * len(scans), [pyramid] * len(scans),
+                            [point_to_plane] * len(scans), [surface_error] * len(scans),
+                            [field_voxel] * len(scans))
+
+
+# Command line entry point (ultrasound-register), argv defaults to sys.argv[1:]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Registers many segmented scans against one ground truth STL")
+    parser.add_argument("stl", help="ground truth model in STL format")
+    parser.add_argument("scans", nargs="+", help="segmented points csv files")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help=f"ICP correspondence distance (default {THRESHOLD}); with --pyramid the distance of the "
+                             "finest level, the coarser levels scale with it (default: the levels of icp.py)")
+    parser.add_argument("--pyramid", action="store_true", help="coarse to fine ICP instead of a single pass")
+    parser.add_argument("--point-to-plane", action="store_true", help="point to plane ICP against the STL normals")
+    parser.add_argument("--surface-error", action="store_true", help="errors to the STL triangles, not vertices")
+    parser.add_argument("--distance-field", type=float, default=None, metavar="VOXEL",
+                        help="errors from a precomputed distance field with this voxel size (mm)")
+    parser.add_argument("--cache-dir", default=None, help="where the parsed STL is cached")
+    parser.add_argument("--output", default=None, help="csv file for the results (default: stdout)")
+    parser.add_argument("--log-spans", action="store_true", help="log the time of every stage of every scan")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in register_scans(args.stl, args.scans, args.workers, args.threshold, args.pyramid, args.cache_dir,
+                                   args.log_spans, args.point_to_plane, args.surface_error,
+                                   args.distance_field):
+            writer.writerow(row)
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Calibration from the raw segmented points to the coordinates of the ground truth model.
+The calibration is composed into a single affine matrix (ImageToWorld) that is applied in place, in chunks.
+"""
+
+import math
+import numpy as np
+
+# the point file format is shared with the segmentation code
+from segmentation.point_file import read_csv_points, read_points
+
+
+# Reads a raw segmented points csv as a (3, n) array: row in the image, column in the image, frame.
+# singleprobjump.py writes one x,y,z point per line under an "x,y,z" header, older files have one row per axis
+# (see read_csv_points). Binary .pts point files are memory mapped instead of parsed, and their fields copied
+# straight into one (n, 3) float64 array, which is returned transposed (a view) so calibrate(raw, copy=False)
+# can transform it in place.
+def load_raw_points(path):
+    if str(path).endswith(".pts"):
+        records = read_points(path)
+        points = np.empty([len(records), 3])
+        for axis, field in enumerate(["x", "y", "z"]):
+            points[:, axis] = records[field]
+        return points.T
+
+    return read_csv_points(path)
+
+
+# 4x4 homogeneous affine transform, compose with then() (self first, then other)
+class AffineTransform:
+
+    def __init__(self, matrix=None):
+        self.matrix = np.identity(4) if matrix is None else np.asarray(matrix, dtype=np.float64)
+
+    def then(self, other):
+        return AffineTransform(other.matrix @ self.matrix)
+
+    @classmethod
+    def linear(cls, matrix):
+        affine = np.identity(4)
+        affine[:3, :3] = matrix
+        return cls(affine)
+
+    @classmethod
+    def translation(cls, shift):
+        affine = np.identity(4)
+        affine[:3, 3] = shift
+        return cls(affine)
+
+    @classmethod
+    def rotation_z(cls, degrees):
+        t = np.deg2rad(degrees)
+        return cls.linear([[math.cos(t), -1 * math.sin(t), 0], [math.sin(t), math.cos(t), 0], [0, 0, 1]])
+
+    @classmethod
+    def rotation_y(cls, degrees):
+        t = np.deg2rad(degrees)
+        return cls.linear([[math.cos(t), 0, math.sin(t)], [0, 1, 0], [-1 * math.sin(t), 0, math.cos(t)]])
+
+
+# Raw segmented points (row in the image, column in the image, z along the sweep) into the model coordinates.
+# The whole calibration is one affine transform, except for the points of the first frames (z below
+# shift_up_below), whose row is first shifted up by shift_up.
+class ImageToWorld:
+
+    def __init__(self, transform, shift_up=30, shift_up_below=11):
+        self.transform = transform
+        self.shift_up = shift_up
+        self.shift_up_below = shift_up_below
+        self.linear = transform.matrix[:3, :3].T.copy()
+        self.shift = transform.matrix[:3, 3].copy()
+
+    # Transforms the (n, 3) points in place, chunk rows at a time so the temporaries stay small.
+    # Any float dtype works, float32 stays float32. Returns points.
+    def apply(self, points, chunk=65536):
+        dtype = points.dtype
+        linear = self.linear.astype(dtype)
+        shift_up = dtype.type(self.shift_up)
+        # broadcasting a 3 vector over (n, 3) is slow, adding a tiled copy to the flat chunk is not
+        shift = np.tile(self.shift.astype(dtype), min(chunk, len(points)))
+
+        for start in range(0, len(points), chunk):
+            block = points[start:start + chunk]
+            block[:, 0] += (block[:, 2] < self.shift_up_below) * shift_up
+            np.matmul(block, linear, out=block)
+            if block.flags.c_contiguous:
+                flat = block.reshape(-1)
+                flat += shift[:flat.size]
+            else:
+                block += shift[:3]
+
+        return points
+
+    # Transforms every chunk of a stream of (n, 3) chunks in place as it goes past
+    def apply_chunks(self, chunks):
+        for points in chunks:
+            yield self.apply(points)
+
+
+# The calibration of the phantom scans, values are selected through trial and error as per MATLAB code
+def image_to_world():
+    # Axes transformation: x from the column, y from the row, z from the frame
+    x_shift = -43.5
+    y_shift = 95
+    z_shift = 148
+    axes = AffineTransform([[0, 90.0 / 569.0, 0, x_shift],
+                            [-88 / 569, 0, 0, y_shift],
+                            [0, 0, -5.01, z_shift],
+                            [0, 0, 0, 1]])
+
+    # Rotation
+    skew_value = 0.08
+    skew_y = AffineTransform.linear([[1, 0, skew_value], [0, 1, 0], [0, 0, 1]])
+
+    transform = axes.then(skew_y).then(AffineTransform.rotation_z(1)).then(AffineTransform.rotation_y(-0.5))
+
+    # To shift up the points, 11 is a threshold to determine whether to shift up or not
+    return ImageToWorld(transform, shift_up=30, shift_up_below=11)
+
+
+IMAGE_TO_WORLD = image_to_world()
+
+
+# Maps raw segmented points (3, n) into the model coordinates, returns them as an (n, 3) float64 array.
+# With copy=False raw is transformed in place when its transpose already is a writeable C contiguous float64
+# array (as load_raw_points gives for .pts files), raw must then not be used again.
+def calibrate(raw, copy=True):
+    if copy:
+        points = np.array(np.transpose(raw), dtype=np.float64, order="C")
+    else:
+        points = np.require(np.transpose(raw), np.float64, ["C", "W"])
+
+    return IMAGE_TO_WORLD.apply(points)
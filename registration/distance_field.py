@@ -0,0 +1,137 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Precomputed distance field of the ground truth model, so the error of a point is a trilinear lookup.
+The field covers the bounding box of the mesh plus a margin, within the region of registration() (minx..maxx,
+miny..maxy, minz..maxz), at a chosen voxel size and is saved as a .npy file next to the cached STL. Every scan
+and every worker process then memory maps the same file, and an error map costs the same per point whatever the
+size of the mesh.
+
+The field is the distance from every voxel centre to the surface: exact (MeshDistance) within band voxels of the
+surface, and a Euclidean distance transform of the voxelised surface further out, which is off by up to about
+a voxel. Interpolating across the surface also overestimates by up to about half a voxel right next to it.
+Points beyond the margin get the distance at the edge of the field plus the distance to it, an overestimate that
+only matters for points far off the model.
+The build needs about VOXEL_BYTES per voxel and refuses to start if that is more than the memory of the machine.
+For the simple geometric model at 1 mm that is under 1M voxels, where the whole default region would be 180M.
+"""
+
+import json
+import os
+import numpy as np
+
+# Range values for each axis as selected per MATLAB code, as in registration()
+BOUNDS = [(-100, 500), (-100, 400), (-200, 400)]
+
+# mm around the bounding box of the mesh covered by the field
+MARGIN = 20.0
+
+# peak memory of the build per voxel (bytes): the voxelised surface, the distance transform with its feature
+# indices, and the float32 field
+VOXEL_BYTES = 48
+
+
+# Distance field memory mapped from a .npy file and its .json description (origin, voxel size)
+class DistanceField:
+
+    def __init__(self, path):
+        with open(os.path.splitext(path)[0] + ".json") as f:
+            meta = json.load(f)
+        self.origin = np.array(meta["origin"])
+        self.voxel_size = meta["voxel_size"]
+        self.values = np.load(path, mmap_mode="r")
+        self.shape = np.array(self.values.shape)
+
+    # Distance (mm) from every point (n, 3) to the surface, trilinearly interpolated between voxel centres.
+    # Points outside the field get the value at the nearest point of the field plus the distance to it.
+    def lookup(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        grid = (points - self.origin) / self.voxel_size
+        inside = np.clip(grid, 0, self.shape - 1)
+        outside = np.linalg.norm(grid - inside, axis=1) * self.voxel_size
+
+        corner = np.minimum(np.floor(inside).astype(np.intp), self.shape - 2)
+        fraction = inside - corner
+        [i, j, k] = corner.T
+        [fx, fy, fz] = fraction.T
+
+        values = self.values
+        distance = np.zeros(len(points))
+        for dx, wx in [(0, 1 - fx), (1, fx)]:
+            for dy, wy in [(0, 1 - fy), (1, fy)]:
+                for dz, wz in [(0, 1 - fz), (1, fz)]:
+                    distance += wx * wy * wz * values[i + dx, j + dy, k + dz]
+
+        return distance + outside
+
+
+# Writes the distance field of the mesh at voxel_size to path (.npy and .json), over the bounding box of the mesh
+# plus margin (mm) on every side, clipped to bounds [(min, max)] * 3 (all of bounds if the mesh is outside them).
+# band is the number of voxels around the surface whose distances are computed exactly.
+# Raises MemoryError before starting if the build needs more than max_memory bytes (the physical memory of the
+# machine if None).
+def build_distance_field(mesh, path, bounds=BOUNDS, voxel_size=2.0, band=3, margin=MARGIN, max_memory=None):
+    bounds = np.asarray(bounds, dtype=np.float64)
+    vertices = np.asarray(mesh.vertices)
+    # on the voxel grid of bounds, so the voxels are where they would be in a field over all of bounds
+    low = bounds[:, 0] + np.floor((vertices.min(axis=0) - margin - bounds[:, 0]) / voxel_size) * voxel_size
+    high = bounds[:, 0] + np.ceil((vertices.max(axis=0) + margin - bounds[:, 0]) / voxel_size) * voxel_size
+    region = np.column_stack([np.maximum(low, bounds[:, 0]), np.minimum(high, bounds[:, 1])])
+    if len(vertices) and np.all(region[:, 0] < region[:, 1]):
+        bounds = region
+
+    origin = bounds[:, 0] + voxel_size / 2
+    shape = np.maximum(np.floor((bounds[:, 1] - bounds[:, 0]) / voxel_size).astype(int), 2)
+
+    needed = int(np.prod(shape)) * VOXEL_BYTES
+    if max_memory is None:
+        max_memory = physical_memory()
+    if max_memory is not None and needed > max_memory:
+        raise MemoryError(f"A distance field of {shape.tolist()} voxels of {voxel_size:g} mm needs about "
+                          f"{needed / (1 << 30):.1f} GB, only {max_memory / (1 << 30):.1f} GB are available, "
+                          f"use a larger voxel size")
+
+    # voxelise the surface by sampling every triangle finer than half a voxel
+    surface = np.zeros(shape, dtype=bool)
+    for samples in sample_triangles(mesh.triangles, voxel_size / 2):
+        index = np.rint((samples - origin) / voxel_size).astype(np.intp)
+        index = index[np.all((index >= 0) & (index < shape), axis=1)]
+        surface[tuple(index.T)] = True
+
+    if surface.any():
+        import scipy.ndimage
+        distance = scipy.ndimage.distance_transform_edt(~surface, sampling=voxel_size).astype(np.float32)
+    else:
+        distance = np.full(shape, np.inf, dtype=np.float32)
+
+    # the voxels near the surface (and all of them if the surface is outside the field) exactly
+    near = np.nonzero(distance <= band * voxel_size) if surface.any() else np.nonzero(np.ones(shape, dtype=bool))
+    centres = origin + np.column_stack(near) * voxel_size
+    distance[near] = mesh.query(centres)[0]
+
+    # the .npy file is moved into place last, so once it exists the field is complete
+    with open(os.path.splitext(path)[0] + ".json", "w") as f:
+        json.dump(dict(origin=origin.tolist(), voxel_size=voxel_size, bounds=bounds.tolist(), band=band), f)
+    temp = path + ".tmp.npy"
+    np.save(temp, distance)
+    os.replace(temp, path)
+
+
+# Bytes of physical memory, None where the platform does not say
+def physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# Points on triangles (m, 3, 3) no further than spacing apart, yielded a group of triangles at a time.
+# Triangles are grouped by how many times their longest edge has to be divided, and every triangle of a group
+# is sampled on the same barycentric grid.
+def sample_triangles(triangles, spacing):
+    edges = np.linalg.norm(triangles - np.roll(triangles, 1, axis=1), axis=2).max(axis=1)
+    divisions = np.maximum(np.ceil(edges / spacing).astype(int), 1)
+    for n in np.unique(divisions):
+        [i, j] = np.nonzero(np.add.outer(np.arange(n + 1), np.arange(n + 1)) <= n)
+        weights = np.column_stack([n - i - j, i, j]) / n
+        group = triangles[divisions == n]
+        yield np.einsum("kv,tvd->tkd", weights, group).reshape(-1, 3)
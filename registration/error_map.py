@@ -0,0 +1,60 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Error between the segmented points and the ground truth model, shared by the registration scripts.
+"""
+
+import numpy as np
+
+
+# Distance from every segmented point to its nearest ground truth vertex, multiplied by scale.
+# The KD-tree is built once over the vertices (pass tree to reuse one) and queried for all the points
+# in a single call spread over workers threads (-1 uses every core).
+# Returns the error of each point and the index of the vertex it was matched to.
+def get_errors(segmented_points, stl_points, scale=1, max_error=10, tree=None, workers=-1):
+    if tree is None:
+        import scipy.spatial
+        tree = scipy.spatial.cKDTree(stl_points)
+
+    error, nearest = tree.query(segmented_points, workers=workers)
+    error *= scale
+
+    # if the error is too big then it won't display on the colour map because it is a point of less interest
+    error[error > max_error] = 0
+
+    return error, nearest
+
+
+# Distance from every segmented point to the surface of the ground truth (its triangles, not just its vertices),
+# multiplied by scale. mesh is a MeshDistance, like GroundTruth.mesh_distance. signed makes the points inside
+# the model negative. Returns the error of each point and the index of the face it was matched to.
+def get_surface_errors(segmented_points, mesh, scale=1, max_error=10, signed=False, workers=-1):
+    error, nearest = mesh.query(segmented_points, signed=signed, workers=workers)
+    error *= scale
+
+    error[np.abs(error) > max_error] = 0
+
+    return error, nearest
+
+
+# Distance from every segmented point to the surface of the ground truth looked up in its precomputed distance
+# field (a DistanceField, like GroundTruth.distance_field()), multiplied by scale
+def get_field_errors(segmented_points, field, scale=1, max_error=10):
+    error = field.lookup(segmented_points)
+    error *= scale
+
+    error[error > max_error] = 0
+
+    return error
+
+
+# Convert the error array into rgb, blue scaled by the error, with the points over high and under low
+# painted high_colour and low_colour. The thresholds are selected using trial and error per model.
+def get_error_colours(error, high, low, high_colour, low_colour):
+    highest = np.max(error)
+
+    colours = np.zeros((len(error), 3))
+    colours[:, 2] = error * 255 / (highest if highest > 0 else 1)
+    colours[error > high] = high_colour
+    colours[error < low] = low_colour
+
+    return colours
@@ -0,0 +1,109 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+ICP registration helpers shared by the registration scripts.
+"""
+
+import numpy as np
+import open3d
+from timeit import default_timer as timer
+
+# Pyramid levels from coarse to fine as (voxel size, max correspondence distance, max iterations),
+# in the units of the models (mm). A voxel size of 0 means the full resolution clouds.
+PYRAMID_LEVELS = [(8.0, 20.0, 50), (4.0, 10.0, 30), (2.0, 5.0, 20), (0, 2.0, 10)]
+
+
+# PYRAMID_LEVELS with every voxel size and distance scaled so the finest level uses the given correspondence
+# distance (the levels as they are for None)
+def pyramid_levels(distance=None):
+    if distance is None:
+        return PYRAMID_LEVELS
+
+    scale = distance / PYRAMID_LEVELS[-1][1]
+    return [(voxel_size * scale, level_distance * scale, iterations)
+            for voxel_size, level_distance, iterations in PYRAMID_LEVELS]
+
+
+# Coarse to fine ICP. Both clouds are voxel downsampled for every level, ICP runs with a correspondence
+# distance that shrinks level by level, and each level starts from the transformation of the one before.
+# Returns the result of the finest level and a list with the voxel size, distance, iterations allowed,
+# fitness, inlier rmse and time of every level.
+def pyramid_icp(source, target, trans_init=np.identity(4), levels=PYRAMID_LEVELS, estimation=None):
+    if estimation is None:
+        estimation = open3d.registration.TransformationEstimationPointToPoint()
+
+    transformation = trans_init
+    report = []
+    for voxel_size, distance, iterations in levels:
+        start = timer()
+        if voxel_size > 0:
+            level_source = source.voxel_down_sample(voxel_size)
+            level_target = target.voxel_down_sample(voxel_size)
+        else:
+            level_source, level_target = source, target
+
+        criteria = open3d.registration.ICPConvergenceCriteria(max_iteration=iterations)
+        result = open3d.registration.registration_icp(level_source, level_target, distance, transformation,
+                                                      estimation, criteria)
+        transformation = result.transformation
+
+        report.append(dict(voxel_size=voxel_size, distance=distance, max_iteration=iterations,
+                           fitness=result.fitness, inlier_rmse=result.inlier_rmse, seconds=timer() - start))
+
+    return result, report
+
+
+# Prints the per level report of pyramid_icp as a table
+def print_pyramid_report(report):
+    print(f"{'voxel':>8} {'distance':>9} {'iters':>6} {'fitness':>8} {'rmse':>8} {'time (s)':>9}")
+    for level in report:
+        print(f"{level['voxel_size']:>8.2f} {level['distance']:>9.2f} {level['max_iteration']:>6d} "
+              f"{level['fitness']:>8.4f} {level['inlier_rmse']:>8.4f} {level['seconds']:>9.4f}")
+
+
+# ICP run one iteration at a time, so the iterations it takes can be counted (open3d does not report them).
+# Stops like open3d does, once the fitness and inlier rmse both change by less than the relative tolerances.
+# open3d rebuilds the target KD-tree on every call, which the time includes, so only compare runs made this way.
+# Returns the last result and a dict with the iterations, fitness, inlier rmse and time.
+def counted_icp(source, target, distance, trans_init=np.identity(4), estimation=None, max_iteration=30,
+                relative_fitness=1e-6, relative_rmse=1e-6):
+    if estimation is None:
+        estimation = open3d.registration.TransformationEstimationPointToPoint()
+
+    start = timer()
+    one_step = open3d.registration.ICPConvergenceCriteria(max_iteration=1)
+    transformation = trans_init
+    previous = None
+    for iterations in range(1, max_iteration + 1):
+        result = open3d.registration.registration_icp(source, target, distance, transformation, estimation, one_step)
+        transformation = result.transformation
+        if (previous is not None and abs(result.fitness - previous.fitness) < relative_fitness
+                and abs(result.inlier_rmse - previous.inlier_rmse) < relative_rmse):
+            break
+        previous = result
+
+    return result, dict(iterations=iterations, fitness=result.fitness, inlier_rmse=result.inlier_rmse,
+                        seconds=timer() - start)
+
+
+# Registers the model cloud onto the segmented cloud, like the scripts do, with counted_icp.
+# Point to plane needs normals on the target, so the segmented points are registered onto the model (whose
+# cloud must carry the cached STL vertex normals) and the transformation is inverted at the end. The fitness
+# is then the share of segmented points that found a match, rather than the share of model points.
+# Returns the transformation of the model onto the segmented points and the counted_icp report.
+def register_model(model, segmented, distance, trans_init=np.identity(4), point_to_plane=False, max_iteration=30):
+    if not point_to_plane:
+        result, report = counted_icp(model, segmented, distance, trans_init, max_iteration=max_iteration)
+        return np.asarray(result.transformation), report
+
+    estimation = open3d.registration.TransformationEstimationPointToPlane()
+    result, report = counted_icp(segmented, model, distance, np.linalg.inv(trans_init), estimation, max_iteration)
+
+    return np.linalg.inv(result.transformation), report
+
+
+# Prints {name: counted_icp report} as a table
+def print_icp_report(reports):
+    print(f"{'mode':<16} {'iters':>6} {'fitness':>8} {'rmse':>8} {'time (s)':>9}")
+    for name, report in reports.items():
+        print(f"{name:<16} {report['iterations']:>6d} {report['fitness']:>8.4f} {report['inlier_rmse']:>8.4f} "
+              f"{report['seconds']:>9.4f}")
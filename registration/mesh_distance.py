@@ -0,0 +1,263 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Distance from points to the surface of a triangle mesh (the ground truth STL), not just to its vertices.
+The triangles are put in a bounding volume hierarchy (BVH) once, then all the points are pushed through it
+together: every step checks a whole frontier of (point, node) pairs against the node boxes with numpy, drops
+the nodes that are further away than the best distance found so far, and measures the points against the
+triangles of the leaves they reach. The triangles around the nearest vertex (KD-tree) give the starting best, so
+only triangles around the surface near each point are ever visited. Chunks of points run on a thread pool.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+BVH_ARRAYS = ["order", "lo", "hi", "child", "start", "count"]
+
+
+class MeshDistance:
+
+    # vertices (n, 3) and faces (m, 3) indexing into them, as cached by stl_cache.
+    # bvh is the dict of arrays returned by arrays() to reuse a saved hierarchy instead of building it.
+    def __init__(self, vertices, faces, leaf_size=8, bvh=None, tree=None):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces)
+        self.leaf_size = leaf_size
+        if tree is None:
+            import scipy.spatial
+            tree = scipy.spatial.cKDTree(self.vertices)
+        self.tree = tree
+
+        if bvh is None:
+            bvh = build_bvh(self.vertices[self.faces], leaf_size)
+        for name in BVH_ARRAYS:
+            setattr(self, name, np.asarray(bvh[name]))
+
+        # triangles in leaf order, so a leaf is a contiguous slice
+        self.triangles = self.vertices[self.faces[self.order]]
+
+        # the triangles (in leaf order) around every vertex are around[around_start[v]:around_start[v + 1]]
+        leaf_rank = np.empty(len(self.order), dtype=np.intp)
+        leaf_rank[self.order] = np.arange(len(self.order))
+        corners = self.faces.reshape(-1)
+        self.around = leaf_rank[np.argsort(corners, kind="stable") // 3]
+        self.around_start = np.concatenate([[0], np.cumsum(np.bincount(corners, minlength=len(self.vertices)))])
+        self.triangle_lo = self.triangles.min(axis=1)
+        self.triangle_hi = self.triangles.max(axis=1)
+
+        cross = np.cross(self.triangles[:, 1] - self.triangles[:, 0], self.triangles[:, 2] - self.triangles[:, 0])
+        self.normals = cross / np.maximum(np.linalg.norm(cross, axis=1, keepdims=True), 1e-12)
+
+    # The hierarchy as a dict of arrays, for saving next to the cached STL
+    def arrays(self):
+        return {name: getattr(self, name) for name in BVH_ARRAYS}
+
+    # Distance from every point (n, 3) to the surface, and the index of the nearest face.
+    # signed gives points on the side the face normal points to (outside for an outward facing STL) a positive
+    # distance and the others a negative one. The side is taken from the nearest face only, so it can be wrong
+    # right next to sharp edges. workers threads (-1 for every core) share the points chunk by chunk.
+    def query(self, points, signed=False, workers=-1, chunk=4096):
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        distance = np.empty(len(points))
+        nearest = np.empty(len(points), dtype=np.intp)
+
+        def run(start):
+            end = start + chunk
+            distance[start:end], nearest[start:end] = self.query_chunk(points[start:end], signed)
+
+        workers = os.cpu_count() if workers == -1 else workers
+        starts = range(0, len(points), chunk)
+        if workers > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, starts))
+        else:
+            for start in starts:
+                run(start)
+
+        return distance, self.order[nearest]
+
+    def query_chunk(self, points, signed=False):
+        n = len(points)
+
+        # the triangles around the nearest vertex give a close upper bound to start from
+        vertex_distance, vertex = self.tree.query(points)
+        counts = self.around_start[vertex + 1] - self.around_start[vertex]
+        pair_query = np.repeat(np.arange(n), counts)
+        first = np.cumsum(counts) - counts
+        position = np.arange(len(pair_query)) - np.repeat(first, counts) + self.around_start[vertex[pair_query]]
+        triangle = self.around[position]
+
+        squared = closest_squared(points[pair_query], self.triangles[triangle])[0]
+        best = np.minimum.reduceat(squared, first)
+        best_triangle = np.empty(n, dtype=np.intp)
+        hit = squared <= best[pair_query]
+        best_triangle[pair_query[hit]] = triangle[hit]
+
+        offsets = np.arange(self.leaf_size)
+        query = np.arange(n)
+        node = np.zeros(n, dtype=np.intp)
+        while len(query):
+            # drop the nodes whose box is further away than the best so far
+            keep = box_squared(points[query], self.lo[node], self.hi[node]) <= best[query]
+            query, node = query[keep], node[keep]
+
+            leaf = self.child[node] < 0
+            if leaf.any():
+                leaf_query, leaf_node = query[leaf], node[leaf]
+                triangle = self.start[leaf_node][:, np.newaxis] + offsets
+                valid = offsets < self.count[leaf_node][:, np.newaxis]
+                pair_query = np.broadcast_to(leaf_query[:, np.newaxis], triangle.shape)[valid]
+                triangle = triangle[valid]
+
+                # the box of each triangle is a much closer bound than the box of its leaf
+                near = box_squared(points[pair_query], self.triangle_lo[triangle], self.triangle_hi[triangle])
+                near = near <= best[pair_query]
+                pair_query, triangle = pair_query[near], triangle[near]
+
+                squared = closest_squared(points[pair_query], self.triangles[triangle])[0]
+                np.minimum.at(best, pair_query, squared)
+                hit = squared <= best[pair_query]
+                best_triangle[pair_query[hit]] = triangle[hit]
+
+            inner_query, inner_node = query[~leaf], node[~leaf]
+            query = np.concatenate([inner_query, inner_query])
+            node = np.concatenate([self.child[inner_node], self.child[inner_node] + 1])
+
+        distance = np.sqrt(best)
+        if signed:
+            closest = closest_squared(points, self.triangles[best_triangle])[1]
+            side = np.einsum("ij,ij->i", points - closest, self.normals[best_triangle])
+            distance = np.where(side < 0, -distance, distance)
+
+        return distance, best_triangle
+
+
+# Squared distance from points (k, 3) to the boxes lo, hi (k, 3) pairwise, 0 inside
+def box_squared(points, lo, hi):
+    gap = np.maximum(lo - points, 0)
+    gap += np.maximum(points - hi, 0)
+
+    return np.einsum("ij,ij->i", gap, gap)
+
+
+# Builds the BVH over triangles (m, 3, 3) one level at a time, every node of a level split at once: each node is
+# sorted along the longest side of the box around its triangle centroids and cut in half, until at most
+# leaf_size triangles are left. Nodes are numbered level by level, the children of node i are child[i] and
+# child[i] + 1 (child is -1 for leaves), and the triangles of a node are order[start:start + count].
+def build_bvh(triangles, leaf_size=8):
+    m = len(triangles)
+    centroid = triangles.mean(axis=1)
+    low = triangles.min(axis=1)
+    high = triangles.max(axis=1)
+    order = np.arange(m)
+
+    levels = []
+    starts = np.array([0])
+    ends = np.array([m])
+    next_id = 1
+    while len(starts):
+        lo = reduce_ranges(np.minimum, low[order], starts, ends)
+        hi = reduce_ranges(np.maximum, high[order], starts, ends)
+        child = np.full(len(starts), -1)
+
+        split = ends - starts > leaf_size
+        if split.any():
+            split_starts, split_ends = starts[split], ends[split]
+            extent = (reduce_ranges(np.maximum, centroid[order], split_starts, split_ends)
+                      - reduce_ranges(np.minimum, centroid[order], split_starts, split_ends))
+            axis = np.argmax(extent, axis=1)
+
+            # every triangle of the nodes being split, sorted by node and then along that node's axis
+            lengths = split_ends - split_starts
+            owner = np.repeat(np.arange(len(split_starts)), lengths)
+            index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + split_starts[owner]
+            values = centroid[order[index], axis[owner]]
+            order[index] = order[index][np.lexsort((values, owner))]
+
+            child[split] = next_id + 2 * np.arange(len(split_starts))
+            next_id += 2 * len(split_starts)
+            middle = (split_starts + split_ends) // 2
+            next_starts = np.column_stack([split_starts, middle]).reshape(-1)
+            next_ends = np.column_stack([middle, split_ends]).reshape(-1)
+        else:
+            next_starts = next_ends = np.array([], dtype=int)
+
+        levels.append((lo, hi, child, starts, ends - starts))
+        starts, ends = next_starts, next_ends
+
+    lo, hi, child, start, count = (np.concatenate(arrays) for arrays in zip(*levels))
+
+    return dict(order=order, lo=lo, hi=hi, child=child, start=start, count=count)
+
+
+# ufunc.reduce of values over every [start, end) range, the ranges sorted and not overlapping
+def reduce_ranges(ufunc, values, starts, ends):
+    # reduceat needs indices inside the array, so pad one row for ranges that end at the last row
+    padded = np.concatenate([values, values[:1]])
+    bounds = np.column_stack([starts, ends]).reshape(-1)
+
+    return ufunc.reduceat(padded, bounds)[::2]
+
+
+# Squared distance from points (k, 3) to triangles (k, 3, 3) pairwise, and the closest points on the triangles.
+# The Voronoi region tests of Ericson's Real-Time Collision Detection (5.1.5), all pairs at once.
+def closest_squared(points, triangles):
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    ab = b - a
+    ac = c - a
+
+    def dot(u, v):
+        return np.einsum("ij,ij->i", u, v)
+
+    ap = points - a
+    d1 = dot(ab, ap)
+    d2 = dot(ac, ap)
+    bp = points - b
+    d3 = dot(ab, bp)
+    d4 = dot(ac, bp)
+    cp = points - c
+    d5 = dot(ab, cp)
+    d6 = dot(ac, cp)
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    # closest point is a + v * ab + w * ac, start from the inside of the face and overwrite by the regions
+    # in reverse order of precedence
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = va + vb + vc
+        v = vb / total
+        w = vc / total
+
+        edge = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        t = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        v = np.where(edge, 1 - t, v)
+        w = np.where(edge, t, w)
+
+        edge = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        v = np.where(edge, 0, v)
+        w = np.where(edge, d2 / (d2 - d6), w)
+
+        corner = (d6 >= 0) & (d5 <= d6)
+        v = np.where(corner, 0, v)
+        w = np.where(corner, 1, w)
+
+        edge = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = np.where(edge, d1 / (d1 - d3), v)
+        w = np.where(edge, 0, w)
+
+        corner = (d3 >= 0) & (d4 <= d3)
+        v = np.where(corner, 1, v)
+        w = np.where(corner, 0, w)
+
+        corner = (d1 <= 0) & (d2 <= 0)
+        v = np.where(corner, 0, v)
+        w = np.where(corner, 0, w)
+
+    closest = a + v[:, np.newaxis] * ab + w[:, np.newaxis] * ac
+    offset = points - closest
+    squared = dot(offset, offset)
+
+    # degenerate triangles give nan, their vertices and edges are covered by the triangles around them
+    return np.where(np.isnan(squared), np.inf, squared), closest
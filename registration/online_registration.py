@@ -0,0 +1,153 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Online registration of a sweep while it is being segmented.
+The ground truth target (cached arrays, KD-tree and point cloud) is built once. Raw points are added a frame
+(or a window of frames) at a time, calibrated in place as they arrive, and every few frames the points of the
+most recent frames are registered onto the ground truth again, starting from the last transformation, so a
+current alignment and error estimate is available mid-scan. An update costs the same however long the scan is.
+
+Replaying a finished scan: ultrasound-register-online ground_truth.stl raw_segmented_points.pts --every 5
+"""
+
+import argparse
+import numpy as np
+import open3d
+from timeit import default_timer as timer
+
+from instrumentation import metrics
+
+from .calibration import IMAGE_TO_WORLD, load_raw_points
+from .error_map import get_errors
+from .point_clouds import make_point_cloud
+from .stl_cache import load_ground_truth
+
+
+class OnlineRegistration:
+
+    # every is the number of add() calls between ICP updates, iterations the ICP iterations per update and
+    # window the number of most recent add() calls whose points ICP registers (0 for all of them).
+    # Each update starts from the previous transformation, so a few iterations per update are enough.
+    # The ground truth cloud carries the STL vertex normals, so estimation can be point to plane.
+    def __init__(self, stl_path, cache_dir=None, threshold=0.005, every=1, iterations=30, estimation=None,
+                 window=50):
+        with metrics.span("stl_load"):
+            self.ground_truth = load_ground_truth(stl_path, cache_dir)
+            self.tree = self.ground_truth.tree
+            self.target = make_point_cloud(self.ground_truth.vertices, normals=self.ground_truth.vertex_normals)
+
+        if estimation is None:
+            estimation = open3d.registration.TransformationEstimationPointToPoint()
+        self.estimation = estimation
+        self.criteria = open3d.registration.ICPConvergenceCriteria(max_iteration=iterations)
+        self.threshold = threshold
+        self.every = every
+        self.window = window
+        self.reset()
+
+    # Forget the points and the transformation, ready for the next sweep
+    def reset(self):
+        self.points = np.empty([1024, 3])
+        self.count = 0
+        self.chunks = 0
+        # where the points of every add() call start
+        self.starts = []
+        self.transformation = np.identity(4)
+        self.state = None
+
+    # Adds the raw points (n, 3) of one frame or window (row in the image, column in the image, z) and
+    # updates the registration if it is due. Returns the current state (see update), None before the first update.
+    def add(self, raw_points):
+        raw_points = np.asarray(raw_points).reshape(-1, 3)
+        n = len(raw_points)
+
+        # grow by doubling, so adding frames one by one stays linear overall
+        if self.count + n > len(self.points):
+            grown = np.empty([max(2 * len(self.points), self.count + n), 3])
+            grown[:self.count] = self.points[:self.count]
+            self.points = grown
+
+        chunk = self.points[self.count:self.count + n]
+        chunk[...] = raw_points
+        IMAGE_TO_WORLD.apply(chunk)
+        self.starts.append(self.count)
+        self.count += n
+        self.chunks += 1
+
+        if self.chunks % self.every == 0:
+            self.update()
+
+        return self.state
+
+    # Runs ICP on the points of the last window add() calls from the last transformation, then measures the
+    # error of those points moved onto the model. Returns a dict with the transformation (of the model onto the
+    # segmented points, as in the scripts), fitness, inlier rmse, error statistics (mm) and the time the update took.
+    # Like register_model does for point to plane, the segmented points are registered onto the fixed ground truth
+    # cloud and the transformation is inverted, so only the few points of the window are turned into a cloud.
+    # The fitness is the share of those points that found a match.
+    def update(self):
+        if self.count == 0:
+            return self.state
+
+        start = timer()
+        first = self.starts[-self.window] if 0 < self.window < len(self.starts) else 0
+        segmented_points = self.points[first:self.count]
+        with metrics.span("icp", points=len(segmented_points)):
+            source = make_point_cloud(segmented_points)
+            result = open3d.registration.registration_icp(source, self.target, self.threshold,
+                                                          np.linalg.inv(self.transformation), self.estimation,
+                                                          self.criteria)
+        registration = np.asarray(result.transformation)
+        self.transformation = np.linalg.inv(registration)
+
+        with metrics.span("error", points=len(segmented_points)):
+            registered = segmented_points @ registration[:3, :3].T + registration[:3, 3]
+            error, nearest = get_errors(registered, None, max_error=np.inf, tree=self.tree)
+
+        self.state = dict(points=self.count, icp_points=len(segmented_points), chunks=self.chunks,
+                          transformation=self.transformation, fitness=result.fitness,
+                          inlier_rmse=result.inlier_rmse, error_mean=np.mean(error), error_median=np.median(error),
+                          error_p95=np.percentile(error, 95), seconds=timer() - start)
+
+        return self.state
+
+
+# Splits raw points (3, n) into the (n, 3) points of every frame, in the order the frames were scanned
+def frames_of(raw):
+    raw = np.asarray(raw)
+    z = raw[2]
+    starts = np.flatnonzero(np.diff(z, prepend=z[:1] - 1))
+    for start, end in zip(starts, np.append(starts[1:], len(z))):
+        yield raw[:, start:end].T
+
+
+# Command line entry point (ultrasound-register-online), argv defaults to sys.argv[1:]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays a segmented scan through online registration")
+    parser.add_argument("stl", help="ground truth model in STL format")
+    parser.add_argument("points", help="segmented points, csv or .pts")
+    parser.add_argument("--every", type=int, default=5, help="frames between registration updates")
+    parser.add_argument("--iterations", type=int, default=30, help="ICP iterations per update")
+    parser.add_argument("--window", type=int, default=50,
+                        help="frames of points registered at every update, the most recent ones (0 for all)")
+    parser.add_argument("--threshold", type=float, default=0.005, help="ICP correspondence distance")
+    parser.add_argument("--cache-dir", default=None, help="where the parsed STL is cached")
+    args = parser.parse_args(argv)
+
+    online = OnlineRegistration(args.stl, args.cache_dir, args.threshold, args.every, args.iterations,
+                                window=args.window)
+    print(f"{'frames':>7} {'points':>8} {'fitness':>8} {'rmse':>8} {'mean':>8} {'p95':>8} {'time (s)':>9}")
+    for frame in frames_of(load_raw_points(args.points)):
+        state = online.add(frame)
+        if state is not None and state["chunks"] == online.chunks:
+            print(f"{state['chunks']:>7d} {state['points']:>8d} {state['fitness']:>8.4f} "
+                  f"{state['inlier_rmse']:>8.4f} {state['error_mean']:>8.3f} {state['error_p95']:>8.3f} "
+                  f"{state['seconds']:>9.4f}")
+
+    # the frames since the last update
+    if online.chunks % online.every:
+        state = online.update()
+        print(f"Final: fitness {state['fitness']:.4f}, mean error {state['error_mean']:.3f} mm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+open3d point clouds built straight from the numpy arrays of the registration scripts.
+"""
+
+import os
+import threading
+import numpy as np
+import open3d
+
+
+# Point cloud from an (n, 3) array of points, and optionally (n, 3) arrays of colours and normals.
+# Vector3dVector needs writeable C contiguous float64 arrays, anything else is copied into one first (vector3d).
+# The cached ground truth arrays are read only memory maps, and its vertices float32, so they always take one copy.
+def make_point_cloud(points, colours=None, normals=None):
+    pcd = open3d.geometry.PointCloud()
+    pcd.points = vector3d(points)
+    if colours is not None:
+        pcd.colors = vector3d(colours)
+    if normals is not None:
+        pcd.normals = vector3d(normals)
+
+    return pcd
+
+
+# Vector3dVector of an (n, 3) array, copied only if it is not already writeable, C contiguous float64
+def vector3d(values):
+    return open3d.utility.Vector3dVector(np.require(values, np.float64, ["C", "W"]))
+
+
+# Writes {file name: point cloud} as ply files into directory on a background thread, so the export
+# overlaps with the registration. Returns the thread, join it before relying on the files.
+def export_point_clouds(clouds, directory):
+    def write():
+        os.makedirs(directory, exist_ok=True)
+        for name, pcd in clouds.items():
+            open3d.io.write_point_cloud(os.path.join(directory, name), pcd)
+
+    thread = threading.Thread(target=write, name="ply-export")
+    thread.start()
+
+    return thread
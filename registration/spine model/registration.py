@@ -11,16 +11,22 @@ Note: This program is only valid for phantom 3 scan 2
 
 # Modules to import
 import numpy as np
-import math
-import pandas as pd
-from stl.mesh import Mesh
 import open3d
-import scipy.spatial
-import scipy.io
+import os
+import sys
 import copy
-import trimesh
 import matplotlib.pyplot as plt
 
+# the registration and segmentation packages live two folders up. Put first, ahead of the folder of this script,
+# which Python searches first and which holds a registration.py of its own in the spine model
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from registration.error_map import get_errors, get_error_colours
+from registration.stl_cache import load_ground_truth
+from registration.point_clouds import make_point_cloud, export_point_clouds
+from registration.icp import pyramid_icp, print_pyramid_report, register_model, print_icp_report
+from registration.calibration import calibrate, load_raw_points
+from instrumentation import metrics
+
 
 # ICP registration
 def draw_registration_result_original_color(source, target, transformation):
@@ -29,144 +35,53 @@ def draw_registration_result_original_color(source, target, transformation):
     source_temp.paint_uniform_color([0.5, 0.5, 0.5])
     open3d.visualization.draw_geometries([source_temp, target])
 
-def registration(raw):
-
-    correct = np.array(raw)
-
-    # To shift up the points, 11 is a threshold to determine whether to shift up or not
-    numCols = len(raw[2])
-    to_shift_up = [0] * numCols
-    for col in range(numCols):
-        if raw[2][col] < 11:
-            to_shift_up[col] = 30
-        else:
-            to_shift_up[col] = 0
-
-    raw[0] = raw[0] + to_shift_up
-
-    # Axes Transformation, values are selected through trial and error as per MATLAB code
-    x_shift = -43.5;
-    y_shift = 95;
-    z_shift = 148;
+# export_dir, if given, is where the point clouds are saved as ply files
+# pyramid runs ICP coarse to fine over voxel downsampled clouds instead of once at full resolution
+# point_to_plane runs point to plane ICP against the normals of the STL and prints its iterations and time
+def registration(raw, export_dir=None, pyramid=False, point_to_plane=False):
 
-    correct[0] = raw[1] * 90.0 / 569.0 + x_shift
-    correct[1] = (raw[0] * (-88) / 569) + y_shift
-    correct[2] = raw[2] * (-5.01) + z_shift
+    # Raw points into the coordinates of the STL model
+    segmented_points = calibrate(raw)
 
     np.set_printoptions(precision=3)  # Prints array in 3 decimal places
 
-    # Rotation
-    skew_value = 0.08
-    skew_y = np.array([[1, 0, skew_value], [0, 1, 0], [0, 0, 1]])
-
-    correct = np.dot(skew_y, correct)
-
-    tz = np.deg2rad(1)
-    ty = np.deg2rad(-0.5)
-
-    Rz = [[math.cos(tz), -1 * math.sin(tz), 0], [math.sin(tz), math.cos(tz), 0], [0, 0, 1]]
-    Ry = [[math.cos(ty), 0, math.sin(ty)], [0, 1, 0], [-1 * math.sin(ty), 0, math.cos(ty)]]
-
-    correct = np.dot(Rz, correct)
-    correct = np.dot(Ry, correct)
-
     # Get STL model
     path = "/Users/puaqieshang/Desktop/Taste of Research/everything/models/Segmentation_bone.stl"
-    stl_mesh = Mesh.from_file(path)
-    points = np.around(np.unique(stl_mesh.vectors.reshape([stl_mesh.vectors.size // 3, 3]), axis=0), 2)
-
-    # Displays the model, eliminate outlier points that are too far
-    # Range values for each axis as selected per MATLAB code
-    minz = -200
-    maxz = 400
-
-    miny = -100
-    maxy = 400
-
-    minx = -100
-    maxx = 500
-
-    # p represents point cloud
-    px = np.bitwise_and(points[0, :] > minx, points[0, :] < maxx)
-    py = np.bitwise_and(points[1, :] > miny, points[1, :] < maxy)
-    pz = np.bitwise_and(points[2, :] > minz, points[2, :] < maxz)
-    p = np.bitwise_and(px, py, pz)
+    # parsed and deduplicated once, later runs memory map the cached arrays
+    with metrics.span("stl_load"):
+        ground_truth = load_ground_truth(path)
+    points = np.asarray(ground_truth.vertices)
 
-    # Transpose segmented points to be in dimensions (number of rows, 3)
-    segmented_points = np.transpose(correct)
-
-    num_rows = np.ma.size(segmented_points, 0)
-    points = np.transpose(points)
-
-    # Array to store the error for colour map
-    error = np.ones((num_rows, 1))
-
-    # For loop determines the colour map or the error when mapping segmented points to stl
-    for i in range(num_rows):  # 39372
-        point = segmented_points[i, :]  # extracting each row from segmented points
-        point_p2 = points[:, i]
-
-        # euclidean distance between the segmented points and the stl model
-        dist = scipy.spatial.distance.euclidean(point_p2, point)
-        dist = dist / 100
-
-        if (dist > 10):
-            error[i] = 0; # if the error is too big then it won't display on the colour map because
-                          # it is a point of less interest
-        elif np.mean(points[p, 1]) < point[1]:
-            error[i] = np.mean(dist)
-        else:
-            error[i] = np.mean(dist)
-
-    # ignore negative errors
-    for i in range(num_rows):
-        if (error[i] < 0):
-            error[i] = 0
+    # Error of each point is the distance to the nearest vertex of the stl model,
+    # divided by 100 as before since the colour thresholds below were tuned on that scale
+    with metrics.span("error"):
+        error, nearest = get_errors(segmented_points, points, scale=1 / 100, tree=ground_truth.tree)
 
     # Outputs maximum and minimum error
-    highest = max(error)
-    lowest = min(error)
+    highest = np.max(error)
+    lowest = np.min(error)
     print(f"The maximum error is {highest}mm")
     print(f"The minimum error is {lowest}mm")
 
     # Use a temp variable to store the error array of each point
-    temp = error;
-
-    # Convert error array into rgb and store in colours array
-    error = error * 255 / highest
-    zeroes = np.zeros((39372, 2))
-    colours = np.append(zeroes, error, axis=1)
+    temp = error
 
     # Displays colour map depending on error, the threshold are selected using trial and error
-    for i in range(len(temp)):
-        if temp[i] > 1.7:
-            colours[i] = [0, 255, 0] # green colour means more error
-            continue
-
-        if temp[i] < 0.5:
-            colours[i] = [0, 0, 255] # blue colour means less error
-            continue
-
-
-    # Display the STL Point Cloud and Segmented Points
-    pcd_image = open3d.geometry.PointCloud()
-    pcd_image.points = open3d.utility.Vector3dVector(segmented_points)
-    pcd_image.colors = open3d.utility.Vector3dVector(colours)
+    # over 1.7 is green colour means more error, under 0.5 is blue colour means less error
+    colours = get_error_colours(error, 1.7, 0.5, [0, 255, 0], [0, 0, 255])
 
-    # Writing segmented points cloud to an open3d image
-    open3d.io.write_point_cloud("point_cloud_segmented.ply", pcd_image)
-    # Read the point cloud
-    pcd_image = open3d.io.read_point_cloud("point_cloud_segmented.ply")
+    # Segmented points and the STL vertices go straight into open3d point clouds, no ply round trip
+    pcd_image = make_point_cloud(segmented_points, colours)
+    # the cached STL vertex normals come along for point to plane ICP
+    source = make_point_cloud(ground_truth.vertices, normals=ground_truth.vertex_normals)
+    target = pcd_image
 
-    # Load original STL file
-    mesh1 = trimesh.load('/Users/puaqieshang/Desktop/Taste of Research/everything/models/Segmentation_bone.stl')
-    # Convert stl file to ply. The STl file is the ground truth model
-    mesh2 = mesh1.copy()
-    mesh2.export('ground_truth.ply')
+    # The ply files are only written when asked for, in the background while the registration runs
+    exporter = None
+    if export_dir is not None:
+        exporter = export_point_clouds({"point_cloud_segmented.ply": target, "ground_truth.ply": source}, export_dir)
 
     # Set parameters for icp registration
-    source = open3d.io.read_point_cloud("ground_truth.ply")
-    target = open3d.io.read_point_cloud("point_cloud_segmented.ply")
     threshold = 0.005
 
     # Transformation matrix - Identity Matrix
@@ -176,24 +91,40 @@ def registration(raw):
     evaluation = open3d.registration.evaluate_registration(source, target,threshold, trans_init)
 
     # Obtain a registered model
-    reg_p2p = open3d.registration.registration_icp(source, target, threshold,
-                                               trans_init,open3d.registration.TransformationEstimationPointToPoint())
+    with metrics.span("icp"):
+        if point_to_plane:
+            transformation, report = register_model(source, target, threshold, trans_init, point_to_plane=True)
+            print_icp_report({"point to plane": report})
+        elif pyramid:
+            reg_p2p, report = pyramid_icp(source, target, trans_init,
+                                          estimation=open3d.registration.TransformationEstimationPointToPoint())
+            print_pyramid_report(report)
+            transformation = reg_p2p.transformation
+        else:
+            reg_p2p = open3d.registration.registration_icp(source, target, threshold,
+                                                           trans_init,open3d.registration.TransformationEstimationPointToPoint())
+            transformation = reg_p2p.transformation
 
     # Plot registered model
-    draw_registration_result_original_color(source, target, reg_p2p.transformation)
+    draw_registration_result_original_color(source, target, transformation)
 
     # Plot the error distribution
     plt.hist(temp, bins=50)
     plt.gca().set(title='Error/Distance', ylabel='Frequency');
     plt.show()
 
+    if exporter is not None:
+        exporter.join()
+
 # Main file
 def main():
 
     # Retrieve segmented_points data by running registration.m on MATLAB
     # change path if located at another file
     segmented_points_path = "/Users/puaqieshang/Desktop/raw_segmented_points.csv"
-    df = pd.read_csv(segmented_points_path, header=None)
-    registration(np.array(df))
+    raw = load_raw_points(segmented_points_path)
+    registration(raw)
+
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Cache for the ground truth STL model, shared by the registration scripts.
+The STL is parsed and deduplicated once, the arrays are saved as .npy files in a folder named after the
+hash of the STL file, and every later registration memory maps them instead of parsing the STL again.
+Several processes that load the same model share the same pages.
+"""
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+from .mesh_distance import MeshDistance
+from .distance_field import BOUNDS, DistanceField, build_distance_field
+
+# bump when the cached arrays change, old caches are then ignored
+CACHE_VERSION = 1
+
+ARRAYS = ["vertices", "faces", "face_normals", "vertex_normals"]
+
+
+# The cached ground truth of one STL file, the arrays are read only memory maps
+class GroundTruth:
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="r"))
+        self._tree = None
+        self._mesh_distance = None
+
+    # KD-tree over the vertices, built from the memory mapped vertices the first time it is needed in a process.
+    # It is not cached: building it takes milliseconds, a pickled tree would be tied to the scipy version and
+    # unpickling from a shared cache folder would run whatever code the file holds.
+    @property
+    def tree(self):
+        if self._tree is None:
+            import scipy.spatial
+            self._tree = scipy.spatial.cKDTree(self.vertices)
+
+        return self._tree
+
+    # Point to surface distances over the triangles (see mesh_distance.py). The BVH is built the first time
+    # it is needed and then saved next to the arrays.
+    @property
+    def mesh_distance(self):
+        if self._mesh_distance is None:
+            path = os.path.join(self.directory, "bvh.npz")
+            if os.path.exists(path):
+                with np.load(path) as bvh:
+                    self._mesh_distance = MeshDistance(self.vertices, self.faces, bvh=dict(bvh), tree=self.tree)
+            else:
+                self._mesh_distance = MeshDistance(self.vertices, self.faces, tree=self.tree)
+                write_atomic(path, lambda f: np.savez(f, **self._mesh_distance.arrays()))
+
+        return self._mesh_distance
+
+    # Distance field around the mesh within bounds at voxel_size (see distance_field.py), built the first time and
+    # then saved next to the arrays, memory mapped after that
+    def distance_field(self, voxel_size=2.0, bounds=BOUNDS):
+        name = "distance_field_" + "_".join(f"{value:g}" for value in np.ravel(bounds)) + f"_{voxel_size:g}mm.npy"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            build_distance_field(self.mesh_distance, path, bounds, voxel_size)
+
+        return DistanceField(path)
+
+
+# sha256 of the file contents, so a changed STL never picks up a stale cache
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# Loads the ground truth for an STL file, parsing it only if it has not been cached yet.
+# By default the cache lives in a .stl_cache folder next to the STL.
+def load_ground_truth(path, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".stl_cache")
+
+    directory = os.path.join(cache_dir, f"{file_hash(path)}-v{CACHE_VERSION}")
+    if not os.path.isdir(directory):
+        build_cache(path, directory)
+
+    return GroundTruth(directory)
+
+
+# Parses the STL and writes the cache folder. It is filled under a temporary name and renamed at the end,
+# so a process that finds the folder always finds it complete.
+def build_cache(path, directory):
+    from stl.mesh import Mesh
+    stl_mesh = Mesh.from_file(path)
+    triangles = stl_mesh.vectors.reshape([stl_mesh.vectors.size // 3, 3])
+
+    # same vertices as the registration scripts always used, faces index into them
+    unique, inverse = np.unique(triangles, axis=0, return_inverse=True)
+    vertices = np.around(unique, 2)
+    faces = inverse.reshape(-1, 3)
+
+    # unit face normals from the triangles themselves, the normals stored in an STL are often left at zero
+    cross = np.cross(stl_mesh.v1 - stl_mesh.v0, stl_mesh.v2 - stl_mesh.v0).astype(np.float64)
+    face_normals = cross / np.maximum(np.linalg.norm(cross, axis=1, keepdims=True), 1e-12)
+
+    # vertex normals are the area weighted mean of the faces around them (the cross product is twice the area)
+    vertex_normals = np.zeros(vertices.shape)
+    for corner in range(3):
+        np.add.at(vertex_normals, faces[:, corner], cross)
+    vertex_normals /= np.maximum(np.linalg.norm(vertex_normals, axis=1, keepdims=True), 1e-12)
+
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    temp = tempfile.mkdtemp(dir=os.path.dirname(directory))
+    arrays = dict(vertices=vertices, faces=faces, face_normals=face_normals, vertex_normals=vertex_normals)
+    for name in ARRAYS:
+        np.save(os.path.join(temp, name + ".npy"), np.ascontiguousarray(arrays[name]))
+
+    try:
+        os.rename(temp, directory)
+    except OSError:
+        # another process finished first, use theirs
+        for name in os.listdir(temp):
+            os.remove(os.path.join(temp, name))
+        os.rmdir(temp)
+
+
+# Writes a file under a temporary name and renames it into place
+def write_atomic(path, write):
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        write(f)
+    os.replace(temp, path)
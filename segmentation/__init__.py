@@ -0,0 +1,43 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Segmentation of the bone surface in ultrasound scans through dynamic programming.
+The public names below are imported from their modules the first time they are used, so importing the package
+(or one light module of it, like point_file) does not pay for the rest.
+"""
+
+import importlib
+
+# public name -> module of this package it lives in. The find_best_path_jumping function is left out, its name is
+# taken by its module
+EXPORTS = {
+    "ProbMapEngine": "get_prob_map_v2",
+    "PathFinder": "find_best_path_jumping",
+    "PathTracker": "find_best_path_jumping",
+    "MultiScalePathFinder": "find_best_path_jumping",
+    "FrameReader": "frame_source",
+    "read_frame": "frame_source",
+    "detect_roi": "frame_source",
+    "PointWriter": "point_file",
+    "read_points": "point_file",
+    "read_csv_points": "point_file",
+    "get_prob_map": "singleprobjump",
+    "get_highly_likely_points": "singleprobjump",
+    "segment_frames": "singleprobjump",
+    "segment_scan": "singleprobjump",
+    "write_points": "singleprobjump",
+}
+
+__all__ = list(EXPORTS)
+
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(f".{EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(EXPORTS))
@@ -1,72 +1,398 @@
 # All the "find best" functions are variations on the DP section of the algorithm
-# find_best_path_jumping is the one currently used from typing import List
-import pandas as pd
+# find_best_path_jumping is the one currently used
+import cv2
+import numpy as np
+from instrumentation import metrics
 
 
-def find_best_path_jumping(curr):
-    # get the globals
-    # TODO try and remove this bc they slow down everything
-    # global inv_prob  # doesn't change
-    # global cost
-    # global nexts
-    df = pd.read_excel(r'/Users/puaqieshang/Desktop/test.xlsx', sheet_name='inv_prob')
-    inv_prob = df.as_matrix()
+# Sliding window minimum along the last axis of a (..., rows) array, for windows of +-half_width rows.
+# Uses the van Herk / Gil-Werman block trick so every cell costs O(1) no matter how wide the window is.
+# Buffers are allocated once for the given shape and reused on every call, out of bounds rows count as inf.
+class SlidingMin:
 
-    df = pd.read_excel(r'/Users/puaqieshang/Desktop/test.xlsx', sheet_name='cost')
-    cost = df.as_matrix()
+    def __init__(self, shape, half_width):
+        shape = tuple(shape)
+        n = shape[-1]
+        width = 2 * half_width + 1
 
-    df = pd.read_excel(r'/Users/puaqieshang/Desktop/test.xlsx', sheet_name='nexts')
-    nexts = df.as_matrix()
+        # pad so the window centred on every row fits, and round up to whole blocks
+        n_blocks = -(-(n + 2 * half_width) // width) + 1
+        flat_shape = shape[:-1] + (n_blocks * width,)
+        block_shape = shape[:-1] + (n_blocks, width)
 
-    x = 306  # these are hardcoded - should be determined instead.
-    y = 626
+        self.padded = np.full(flat_shape, np.inf)
+        self.blocks = self.padded.reshape(block_shape)
+        self.values = self.padded[..., half_width:half_width + n]
 
-    # if at end
-    if curr[1] is y:
-        curr_cost = 0
-        cost[curr[0]][curr[1]] = curr_cost
-        nexts[curr[1]][curr[2]] = 0
-        return
+        prefix = np.empty(flat_shape)
+        suffix = np.empty(flat_shape)
+        self.prefix_blocks = prefix.reshape(block_shape)
+        self.suffix_blocks = suffix.reshape(block_shape)[..., ::-1]
 
-    max_jump = 50
-    no_cells = max_jump * 2 + 1
+        # the window of row r covers padded cells [r, r + width - 1]
+        self.left = suffix[..., :n]
+        self.right = prefix[..., width - 1:width - 1 + n]
+        self.out = np.empty(shape)
 
-    # create 2x1 array
-    min_next = [0, 0]
-    min_cost = float("inf")
+    def __call__(self, values):
+        self.values[...] = values
+        np.minimum.accumulate(self.blocks, axis=-1, out=self.prefix_blocks)
+        np.minimum.accumulate(self.blocks[..., ::-1], axis=-1, out=self.suffix_blocks)
+        np.minimum(self.left, self.right, out=self.out)
 
-    # calc costs
-    for i in range(1, no_cells):
-        # cell no
-        next = curr + [i - max_jump - 1, 1]
+        return self.out
 
-        # out of bounds
-        if next[0] < 1 or next[0] > x:
-            next_cost = float("inf")
 
-        # already calculated
-        elif cost[next[0]][next[1]] != float("inf"):
-            next_cost = cost[next[0]][next[1]]
-            # print(next_cost)
+# Minimum and its row over windows of +-half_width rows along the last axis, ties go to the smallest row.
+# Covers the window by doubling spans, which keeps every step a plain vectorised np.minimum.
+def window_argmin(values, half_width):
+    values = np.asarray(values, dtype=np.float64)
+    n = values.shape[-1]
+    width = 2 * half_width + 1
 
-        # need to recursively calculate
+    padded = np.full(values.shape[:-1] + (n + 2 * half_width,), np.inf)
+    padded[..., half_width:half_width + n] = values
+    arg = np.broadcast_to(np.arange(-half_width, n + half_width, dtype=np.int32), padded.shape)
+
+    def merge(first, first_arg, second, second_arg):
+        take_first = first <= second
+        return np.minimum(first, second), np.where(take_first, first_arg, second_arg)
+
+    span = 1
+    while span * 2 <= width:
+        m = padded.shape[-1] - span
+        padded, arg = merge(padded[..., :m], arg[..., :m], padded[..., span:span + m], arg[..., span:span + m])
+        span *= 2
+
+    # two overlapping spans cover the rest of the window
+    shift = width - span
+    return merge(padded[..., :n], arg[..., :n], padded[..., shift:shift + n], arg[..., shift:shift + n])
+
+
+# Python Migration of "find_best_path_jumping.m" of MATLAB
+# Applies Dynamic Programming to calculate the path of least cost, column by column from the last
+# column back to the first instead of recursing one cell at a time.
+# Jumps of up to free_jump rows are free, anything up to max_jump rows costs a flat penalty, so the
+# best jump for every cell is the smaller of a narrow and a wide sliding window minimum.
+# Returns the cost map, the back pointers (row taken in the next column) and the traced path (row per column).
+# nexts=False skips the back pointers of the cells off the path (None is returned for them), which is all the
+# segmentation needs and saves about 40% of the time.
+def find_best_path_jumping(inv_prob, max_jump=50, start_row=None, free_jump=2, penalty=0.2, nexts=True):
+    inv_prob = np.asarray(inv_prob, dtype=np.float64)
+    cost, all_nexts, path = PathFinder(max_jump, free_jump, penalty, nexts)(inv_prob[np.newaxis], start_row)
+
+    return cost[0].copy(), all_nexts[0].copy() if nexts else None, path[0]
+
+
+# Same DP as find_best_path_jumping, vectorised across a stack of frames (n_frames, rows, cols).
+# The work buffers are kept between calls and only reallocated when the stack shape changes, so a sweep
+# can be pushed through batch after batch. The returned cost and nexts are views into those buffers and
+# are overwritten by the next call. With nexts=False only the paths are traced (follow_cost) and nexts is None.
+# max_jump includes the free jumps, so it cannot be smaller than free_jump.
+class PathFinder:
+
+    def __init__(self, max_jump=50, free_jump=2, penalty=0.2, nexts=True):
+        if max_jump < free_jump:
+            raise ValueError(f"max_jump ({max_jump}) cannot be smaller than free_jump ({free_jump})")
+        self.free_jump = free_jump
+        self.max_jump = max_jump
+        self.penalty = penalty
+        self.keep_nexts = nexts
+        self.shape = None
+
+    def allocate(self, shape):
+        [n, a, b] = shape
+        self.shape = tuple(shape)
+
+        # column major so every column of every frame is a contiguous row
+        self.cost = np.empty([b, n, a])
+        self.nexts = np.full([b, n, a], -1, dtype=np.intp) if self.keep_nexts else None
+        self.near = SlidingMin([n, a], self.free_jump)
+        self.far = SlidingMin([n, a], self.max_jump)
+        self.frames = np.arange(n)
+
+    def __call__(self, inv_prob, start_row=None):
+        inv_prob = np.asarray(inv_prob)
+        if inv_prob.shape != self.shape:
+            self.allocate(inv_prob.shape)
+
+        [n, a, b] = self.shape
+        cost = self.cost
+        inv_prob_cols = inv_prob.transpose(2, 0, 1)
+
+        # at the end the cost is just the cell itself
+        cost[b - 1] = inv_prob_cols[b - 1]
+
+        for col in range(b - 2, -1, -1):
+            far_cost = self.far(cost[col + 1])
+            far_cost += self.penalty
+            np.minimum(self.near(cost[col + 1]), far_cost, out=cost[col])
+            cost[col] += inv_prob_cols[col]
+
+        if start_row is None:
+            start_row = a // 2
+
+        if not self.keep_nexts:
+            with metrics.span("trace"):
+                paths = np.stack([follow_cost(cost[:, frame], start_row, self.max_jump, self.free_jump,
+                                              self.penalty) for frame in range(n)])
+            return cost.transpose(1, 2, 0), None, paths
+
+        with metrics.span("trace"):
+            # the recurrence only needs the minimums, the back pointers are found afterwards a few columns at a
+            # time (as many as keep the temporaries around cache size)
+            step = max(1, 65536 // (n * a))
+            for col in range(0, b - 1, step):
+                end = min(col + step, b - 1)
+                self.nexts[col:end] = best_next(cost[col + 1:end + 1], self.max_jump, self.free_jump, self.penalty)
+
+            paths = np.empty([n, b], dtype=np.intp)
+            paths[:, 0] = start_row
+            for col in range(b - 1):
+                paths[:, col + 1] = self.nexts[col, self.frames, paths[:, col]]
+
+        return cost.transpose(1, 2, 0), self.nexts.transpose(1, 2, 0), paths
+
+
+# Row of the cheapest next cell for every row of next_cost (..., rows), preferring the free jump on ties
+def best_next(next_cost, max_jump, free_jump=2, penalty=0.2):
+    near_cost, near_row = window_argmin(next_cost, free_jump)
+    far_cost, far_row = window_argmin(next_cost, max_jump)
+
+    return np.where(near_cost <= far_cost + penalty, near_row, far_row)
+
+
+# Traces the path from start_row through a cost map (cols, rows) without any back pointers: in every column only
+# the windows around the row the path is on are searched, with the same choice (and ties) as best_next.
+# Costs a few slices per column instead of the back pointers of every cell.
+def follow_cost(cost, start_row, max_jump, free_jump=2, penalty=0.2):
+    [b, a] = np.shape(cost)
+    path = np.empty(b, dtype=np.intp)
+    row = path[0] = start_row
+    for col in range(1, b):
+        column = cost[col]
+        far_start = max(row - max_jump, 0)
+        far = column[far_start:row + max_jump + 1]
+        far_row = far.argmin()
+        near_start = max(row - free_jump, 0)
+        near = column[near_start:row + free_jump + 1]
+        near_row = near.argmin()
+        if near[near_row] <= far[far_row] + penalty:
+            row = near_start + near_row
         else:
-            next_cost = find_best_path_jumping(next)
-            # print(next_cost)
+            row = far_start + far_row
+        path[col] = row
+
+    return path
+
+
+# Follows the back pointers from start_row in the first column, returns the row of the path in every column
+def trace_path(nexts, start_row):
+    b = np.shape(nexts)[-1]
+    path = np.empty(b, dtype=np.intp)
+    path[0] = start_row
+    for col in range(b - 1):
+        path[col + 1] = nexts[path[col], col]
+
+    return path
+
+
+# Same DP restricted to a band of +-half_band rows around a previous path (the last frame's, in a sweep).
+# Everything outside the band costs inf, so each column only looks at (2 * half_band + 1)^2 jumps instead
+# of rows * (2 * max_jump + 1). The path starts from the previous path's first row unless start_row is given.
+# Returns the cost map (inf outside the band), the back pointers (-1 outside the band) and the traced path.
+def find_best_path_banded(inv_prob, prev_path, half_band, max_jump=50, start_row=None, free_jump=2, penalty=0.2):
+    band = BandSearch(inv_prob, prev_path, half_band, max_jump, free_jump, penalty)
+    cost, nexts = band.maps()
+    path, _ = band.trace(start_row)
+
+    return cost, nexts, path
+
+
+# The banded DP of find_best_path_banded kept in band space: rows[c, k] is the row of cell k of the band in
+# column c, cost and next (the cell taken in the next column) are (cols, 2 * half_band + 1).
+# trace() follows the path through the band without ever building a map of the whole inv_prob.
+class BandSearch:
+
+    def __init__(self, inv_prob, prev_path, half_band, max_jump=50, free_jump=2, penalty=0.2):
+        if max_jump < free_jump:
+            raise ValueError(f"max_jump ({max_jump}) cannot be smaller than free_jump ({free_jump})")
+        inv_prob = np.asarray(inv_prob, dtype=np.float64)
+        [a, b] = np.shape(inv_prob)
+        cols = np.arange(b)[:, np.newaxis]
+        self.prev_path = np.asarray(prev_path)
+        self.half_band = half_band
+        self.rows_total = a
+
+        band_rows = self.prev_path[:, np.newaxis] + np.arange(-half_band, half_band + 1)
+        self.inside = (band_rows >= 0) & (band_rows < a)
+        self.rows = band_rows = np.clip(band_rows, 0, a - 1)
+        band_inv = np.where(self.inside, inv_prob[band_rows, cols], np.inf)
+
+        # cost of jumping from cell k of column c to cell m of column c + 1
+        jump = np.abs(band_rows[:-1, :, np.newaxis] - band_rows[1:, np.newaxis, :])
+        jump_cost = np.where(jump > free_jump, penalty, 0.0)
+        jump_cost[jump > max_jump] = np.inf
+
+        # at the end the cost is just the cell itself
+        self.cost = band_cost = np.empty([b, 2 * half_band + 1])
+        band_cost[b - 1] = band_inv[b - 1]
+
+        total = np.empty(jump_cost.shape[1:])
+        for col in range(b - 2, -1, -1):
+            np.add(jump_cost[col], band_cost[col + 1], out=total)
+            np.minimum.reduce(total, axis=1, out=band_cost[col])
+            band_cost[col] += band_inv[col]
+
+        jump_cost += band_cost[1:, np.newaxis, :]
+        self.next = np.argmin(jump_cost, axis=2)
+
+    # The path (row per column) from start_row, the previous path's first row if None, and its cost.
+    # start_row has to be inside the band of the first column.
+    def trace(self, start_row=None):
+        if start_row is None:
+            start_row = self.prev_path[0]
+        cell = int(start_row - self.prev_path[0]) + self.half_band
+        if not 0 <= cell < self.cost.shape[1] or not self.inside[0, cell]:
+            raise ValueError(f"start_row {start_row} is outside the band around row {self.prev_path[0]}")
+
+        b = len(self.cost)
+        cells = np.empty(b, dtype=np.intp)
+        cells[0] = cell
+        for col in range(b - 1):
+            cells[col + 1] = self.next[col, cells[col]]
+        columns = np.arange(b)
+
+        return self.rows[columns, cells], self.cost[0, cell]
+
+    # The cost map (inf outside the band) and back pointers (-1 outside the band) the size of inv_prob
+    def maps(self):
+        b = len(self.cost)
+        [c, k] = np.nonzero(self.inside)
+        cost = np.full([self.rows_total, b], np.inf)
+        cost[self.rows[c, k], c] = self.cost[c, k]
+
+        nexts = np.full([self.rows_total, b], -1, dtype=np.intp)
+        has_next = c < b - 1
+        band_next = np.take_along_axis(self.rows[1:], self.next, axis=1)
+        nexts[self.rows[c, k][has_next], c[has_next]] = band_next[c[has_next], k[has_next]]
+
+        return cost, nexts
+
+
+# Coarse to fine DP: the full search only runs on the inv_prob map shrunk levels times by 2 (area averages), and
+# every finer level, up to the map itself, only searches a corridor of +-corridor rows around the path of the
+# level below scaled up (BandSearch, which stays in corridor space). max_jump and free_jump are rows per column,
+# which stay the same at every scale. With the same limits the path matches the full search except where two
+# ridges of nearly the same cost are closer than a coarse pixel. levels=1 does most of the saving: the full search
+# is a quarter of the size, coarser levels only shave the rest of it while every level adds a banded pass.
+# Returns the cost map of the finest level (inf outside the corridor), its back pointers and the path. Those maps
+# are the size of inv_prob and only built with maps=True, otherwise both are None.
+class MultiScalePathFinder:
+
+    def __init__(self, levels=1, corridor=4, max_jump=50, free_jump=2, penalty=0.2, maps=False):
+        self.levels = levels
+        self.corridor = corridor
+        self.max_jump = max_jump
+        self.free_jump = free_jump
+        self.penalty = penalty
+        self.maps = maps
+        self.path_finder = PathFinder(max_jump, free_jump, penalty, nexts=False)
+
+    def __call__(self, inv_prob, start_row=None):
+        inv_prob = np.asarray(inv_prob, dtype=np.float64)
+        [a, b] = np.shape(inv_prob)
+        if start_row is None:
+            start_row = a // 2
+
+        # pyramid[0] is the map itself, every level half the size of the one before, no smaller than 2 x 2
+        pyramid = [inv_prob]
+        while len(pyramid) <= self.levels and min(np.shape(pyramid[-1])) >= 4:
+            pyramid.append(shrink(pyramid[-1]))
+
+        coarse = pyramid[-1]
+        cost, nexts, paths = self.path_finder(coarse[np.newaxis], scale_row(start_row, a, coarse.shape[0]))
+        cost, nexts, path = (cost[0] if self.maps else None), None, paths[0]
+        shape = coarse.shape
+
+        for level in pyramid[-2::-1]:
+            band = scale_path(path, shape, level.shape)
+            level_start = scale_row(start_row, a, level.shape[0])
+            band[0] = level_start
+            with metrics.span("refine", rows=level.shape[0]):
+                search = BandSearch(level, band, self.corridor, self.max_jump, self.free_jump, self.penalty)
+                if self.maps and level is inv_prob:
+                    cost, nexts = search.maps()
+                path, _ = search.trace(level_start)
+            shape = level.shape
+
+        return cost, nexts, path
+
+
+# Half size map (rounded up), every cell the area average of the cells it covers
+def shrink(values):
+    [a, b] = np.shape(values)
+    return cv2.resize(values, ((b + 1) // 2, (a + 1) // 2), interpolation=cv2.INTER_AREA)
+
+
+# Row of a map with rows rows that is at the same place as row in a map with from_rows rows
+def scale_row(row, from_rows, rows):
+    return int(np.clip(np.rint((row + 0.5) * rows / from_rows - 0.5), 0, rows - 1))
+
+
+# Path (row per column) of a map of from_shape scaled to a map of shape, the rows interpolated between columns
+def scale_path(path, from_shape, shape):
+    [from_rows, from_cols] = from_shape
+    [rows, cols] = shape
+    at = (np.arange(cols) + 0.5) * from_cols / cols - 0.5
+    row = np.interp(at, np.arange(from_cols), path)
+    return np.clip(np.rint((row + 0.5) * rows / from_rows - 0.5), 0, rows - 1).astype(np.intp)
+
+
+# Tracks the bone surface through a sweep, one frame at a time.
+# The first frame (and any frame after the track is lost) gets the full search. After that the DP only runs
+# in a band around the previous frame's path. If the path cost jumps by more than cost_jump (relative to the
+# last frame) the band is doubled and the frame solved again, and once the band would be wider than
+# max_half_band the track is considered lost and the frame falls back to the full search.
+class PathTracker:
+
+    def __init__(self, max_jump=50, half_band=8, max_half_band=32, cost_jump=0.1, free_jump=2, penalty=0.2):
+        self.max_jump = max_jump
+        self.half_band = half_band
+        self.max_half_band = max_half_band
+        self.cost_jump = cost_jump
+        self.free_jump = free_jump
+        self.penalty = penalty
+        self.reset()
+
+    # Forget the previous path, the next frame gets the full search
+    def reset(self):
+        self.path = None
+        self.path_cost = None
+        self.full_searches = 0
 
-        # add penalty if needed
-        if abs(curr[0] - next[0]) > 2:
-            next_cost = next_cost + 0.2
+    def __call__(self, inv_prob, start_row=None):
+        inv_prob = np.asarray(inv_prob, dtype=np.float64)
+        dp = dict(max_jump=self.max_jump, free_jump=self.free_jump, penalty=self.penalty)
 
-        # calculate running min
-        if next_cost < min_cost:
-            min_cost = next_cost
-            min_next = next[0]
+        result = None
+        if self.path is not None and len(self.path) == np.shape(inv_prob)[1]:
+            half_band = self.half_band
+            while half_band <= self.max_half_band:
+                cost, nexts, path = find_best_path_banded(inv_prob, self.path, half_band, **dp)
+                path_cost = cost[path[0], 0]
+                if path_cost <= self.path_cost + self.cost_jump * abs(self.path_cost):
+                    result = cost, nexts, path
+                    break
+                half_band *= 2
 
-    # set results
-    curr_cost = inv_prob(curr(0), curr(1)) + min_cost
-    cost[curr[0], curr[1]] = curr_cost
-    nexts[curr[0]][curr[1]] = min_next
+        if result is None:
+            if start_row is None and self.path is not None:
+                start_row = self.path[0]
+            result = find_best_path_jumping(inv_prob, start_row=start_row, **dp)
+            self.full_searches += 1
 
+        cost, nexts, path = result
+        self.path, self.path_cost = path, cost[path[0], 0]
 
-find_best_path_jumping([1, 2, 3])  # test if its working
+        return result
@@ -0,0 +1,268 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Frame sources for the segmentation: decode the scans straight to grayscale, crop them to the ultrasound region
+(ROI) and read ahead on background threads, so decoding and file I/O overlap with the prob map and DP of the
+frames before. OpenCV releases the GIL while it decodes, so the threads really do run alongside.
+
+A sweep can be a folder of single images (FrameReader), a video file (VideoReader) or a multi-page image stack
+such as a cine TIFF (StackReader), see open_frames. Every source yields (count, grayscale ROI) with the 1 based
+frame number and gives the z (mm) of a frame with z(count): the frame number times the spacing between frames,
+or with a probe speed (mm/s) the time of the frame (from the video timestamps or the frame rate) times the speed.
+Both start one step in: frame numbers count from 1 and times from one frame period before the first frame, so at
+a steady frame rate z is the frame number times speed / frame rate either way.
+"""
+
+import collections
+import glob
+import itertools
+import logging
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import metrics
+
+# Ultrasound region of the phantom scans as (top, bottom, left, right), i.e. img[80:400, 270:850].
+# The calibration of the registration (calibration.py) is tuned for points in this crop.
+ROI = (80, 400, 270, 850)
+
+logger = logging.getLogger(__name__)
+
+# Distance between frames (mm) when z follows the frame number
+SPACING = 0.2
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".bmp"]
+STACK_EXTENSIONS = [".tif", ".tiff"]
+
+
+# Reads one scan as grayscale and crops it to roi (top, bottom, left, right), raises if it cannot be read
+def read_frame(fname, roi=ROI, count=None):
+    with metrics.span("read", frame=count):
+        img = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(f"Could not read {fname}")
+
+    return crop(img, roi)
+
+
+# The roi (top, bottom, left, right) of a decoded frame as a contiguous grayscale image
+def crop(img, roi):
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    [top, bottom, left, right] = roi
+    return np.ascontiguousarray(img[top:bottom, left:right])
+
+
+# Finds the ultrasound region of an exported scan (grayscale, uncropped) as (top, bottom, left, right).
+# The export is a black background with the image and some small overlays (text, scale marks) on it. Closing
+# the non black pixels merges the speckle of the image into one blob and the largest blob is the image.
+# Falls back to default when no blob covers at least min_fraction of the scan.
+def detect_roi(gray, threshold=0, close=15, min_fraction=0.1, default=ROI):
+    mask = (gray > threshold).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((close, close), np.uint8))
+
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if count < 2:
+        return default
+
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    [left, top, width, height, area] = stats[largest]
+    if area < min_fraction * gray.size:
+        return default
+
+    return int(top), int(top + height), int(left), int(left + width)
+
+
+# detect_roi on the first frame of a sweep, warning when the region found is not the calibrated ROI
+def detect_sweep_roi(gray):
+    roi = detect_roi(gray)
+    if roi != ROI:
+        logger.warning(f"Detected ultrasound region {roi} is not the calibrated {ROI}, the points will not match "
+                       f"the calibration of the registration")
+
+    return roi
+
+
+# Yields (count, grayscale ROI) for every scan in order, like the other pipeline stages.
+# roi is (top, bottom, left, right), the calibrated ROI by default, or None to detect it on the first scan.
+# Up to prefetch frames are decoded ahead of the one being consumed, on workers threads.
+# Single images carry no time, so z follows the frame number.
+class FrameReader:
+
+    def __init__(self, images, roi=ROI, first_frame=1, prefetch=8, workers=4, spacing=SPACING):
+        self.images = list(images)
+        self.roi = roi
+        self.first_frame = first_frame
+        self.prefetch = max(prefetch, 1)
+        self.workers = workers
+        self.spacing = spacing
+
+    def z(self, count):
+        return count * self.spacing
+
+    def __iter__(self):
+        if not self.images:
+            return
+
+        if self.roi is None:
+            self.roi = detect_sweep_roi(read_frame(self.images[0], (None, None, None, None)))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="frame-reader") as pool:
+            in_flight = collections.deque()
+            for count, fname in enumerate(self.images, self.first_frame):
+                in_flight.append((count, pool.submit(read_frame, fname, self.roi, count)))
+                if len(in_flight) >= self.prefetch:
+                    count, future = in_flight.popleft()
+                    yield count, future.result()
+
+            while in_flight:
+                count, future = in_flight.popleft()
+                yield count, future.result()
+
+
+# Base of the sources that decode one stream in order (videos and stacks): frames() yields (time in seconds or
+# None, decoded frame), and a background thread runs it up to prefetch frames ahead of the pipeline.
+# Only the times of the frames in flight are kept, so a sweep of any length streams in constant memory.
+class StreamReader:
+
+    def __init__(self, path, roi=ROI, first_frame=1, prefetch=8, spacing=SPACING, speed=None):
+        self.path = path
+        self.roi = roi
+        self.first_frame = first_frame
+        self.prefetch = max(prefetch, 1)
+        self.spacing = spacing
+        self.speed = speed
+        self.times = {}
+        # seconds between frames, set by frames() when the source knows them
+        self.period = 0
+
+    # With a speed the z of a frame is its time, plus one frame period, times the speed; without one (or without
+    # a time) it follows the frame number. Only valid for the frames yielded last, up to prefetch of them.
+    def z(self, count):
+        time = self.times.get(count)
+        if self.speed is None or time is None:
+            return count * self.spacing
+
+        return (time + self.period) * self.speed
+
+    def __iter__(self):
+        self.times = {}
+        frames = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.decode, args=(frames, stop), name="frame-stream", daemon=True)
+        thread.start()
+        try:
+            recent = collections.deque()
+            while True:
+                item = frames.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+
+                count, time, gray = item
+                self.times[count] = time
+                recent.append(count)
+                if len(recent) > 2 * self.prefetch:
+                    self.times.pop(recent.popleft(), None)
+                yield count, gray
+        finally:
+            # a consumer that stops early leaves the decoder blocked on a full queue, free it
+            stop.set()
+            while thread.is_alive():
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+    # Runs on the background thread: decodes, converts and crops every frame and queues (count, time, gray),
+    # then None at the end (or the exception that stopped it)
+    def decode(self, frames, stop):
+        try:
+            for count, (time, frame) in enumerate(self.frames(), self.first_frame):
+                if stop.is_set():
+                    return
+                if self.roi is None:
+                    self.roi = detect_sweep_roi(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame)
+                frames.put((count, time, crop(frame, self.roi)))
+            frames.put(None)
+        except BaseException as e:
+            frames.put(e)
+
+    def frames(self):
+        raise NotImplementedError
+
+
+# Every frame of a video file (anything cv2.VideoCapture opens), timed by the video timestamps.
+# Containers that carry no timestamps get the frame number over the frame rate.
+class VideoReader(StreamReader):
+
+    def frames(self):
+        capture = cv2.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise FileNotFoundError(f"Could not open {self.path}")
+
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        self.period = 1 / fps if fps > 0 else 0
+        try:
+            for index in itertools.count():
+                with metrics.span("read", frame=self.first_frame + index):
+                    ok, frame = capture.read()
+                if not ok:
+                    return
+
+                time = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                if time <= 0 < index:
+                    time = index / fps if fps > 0 else None
+                yield time, frame
+        finally:
+            capture.release()
+
+
+# Every page of a multi-page image (a cine TIFF stack), read chunk pages at a time so the whole stack is never
+# in memory. Stacks carry no timestamps, give frame_rate (frames per second) to time the pages.
+class StackReader(StreamReader):
+
+    def __init__(self, path, roi=ROI, first_frame=1, prefetch=8, spacing=SPACING, speed=None, frame_rate=None,
+                 chunk=16):
+        super().__init__(path, roi, first_frame, prefetch, spacing, speed)
+        self.frame_rate = frame_rate
+        self.chunk = chunk
+
+    def frames(self):
+        self.period = 1 / self.frame_rate if self.frame_rate else 0
+        pages = cv2.imcount(self.path)
+        if pages == 0:
+            raise FileNotFoundError(f"Could not read {self.path}")
+
+        for start in range(0, pages, self.chunk):
+            with metrics.span("read", frame=self.first_frame + start):
+                ok, chunk = cv2.imreadmulti(self.path, start, min(self.chunk, pages - start),
+                                            flags=cv2.IMREAD_GRAYSCALE)
+            if not ok:
+                raise OSError(f"Could not read pages {start} to {start + self.chunk} of {self.path}")
+
+            for index, page in enumerate(chunk, start):
+                yield (index / self.frame_rate if self.frame_rate else None), page
+
+
+# The frame source for a sweep: a folder of images, a glob pattern of images, a video or a multi-page stack.
+# speed (mm/s) sets z from the frame times, frame_rate times the pages of a stack.
+def open_frames(source, roi=ROI, spacing=SPACING, speed=None, frame_rate=None):
+    extension = os.path.splitext(source)[1].lower()
+    if os.path.isdir(source):
+        images = [path for path in glob.glob(os.path.join(source, "*"))
+                  if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS]
+        return FrameReader(sorted(images), roi, spacing=spacing)
+    if any(character in source for character in "*?["):
+        return FrameReader(sorted(glob.glob(source)), roi, spacing=spacing)
+    if extension in STACK_EXTENSIONS:
+        return StackReader(source, roi, spacing=spacing, speed=speed, frame_rate=frame_rate)
+    if extension in IMAGE_EXTENSIONS:
+        return FrameReader([source], roi, spacing=spacing)
+
+    return VideoReader(source, roi, spacing=spacing, speed=speed)
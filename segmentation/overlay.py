@@ -0,0 +1,121 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Optional visual output of the segmentation: the prob map of a frame with its path drawn on it, red where the
+path is highly likely to be bone and blue elsewhere (the plots main() used to show).
+A frame is rendered with one colour map call and one raster write per colour. The sinks take the rendered
+frames: OverlayWriter saves them as images on a background thread, OverlayWindow shows them without blocking.
+"""
+
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+from instrumentation import metrics
+
+RED = (0, 0, 255)
+BLUE = (255, 0, 0)
+
+
+# BGR image of the prob map (rows, cols) coloured like imshow (viridis over its own range), with the path
+# (the row of every column) drawn as radius pixel wide squares.
+# Path points over 0.05 of the prob map maximum are red, the others blue, as in get_highly_likely_points.
+def render_overlay(prob_map, path, radius=1):
+    prob_map = np.asarray(prob_map)
+    [rows, cols] = np.shape(prob_map)
+    column = np.arange(cols)
+
+    low = prob_map.min()
+    span = prob_map.max() - low
+    scaled = (prob_map - low) * (255 / span if span > 0 else 0)
+    image = cv2.applyColorMap(scaled.astype(np.uint8), cv2.COLORMAP_VIRIDIS)
+
+    likely = prob_map[path, column] > 0.05 * prob_map.max()
+
+    # every offset of the square around every path point, clipped to the image
+    offsets = np.arange(-radius, radius + 1)
+    y = np.clip(path[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis], 0, rows - 1)
+    x = np.clip(column[:, np.newaxis, np.newaxis] + offsets, 0, cols - 1)
+    [y, x] = np.broadcast_arrays(y, x)
+    image[y[likely].ravel(), x[likely].ravel()] = RED
+    image[y[~likely].ravel(), x[~likely].ravel()] = BLUE
+
+    return image
+
+
+# Saves the overlay of every frame as directory/frame_<count>.png. Frames are rendered in the calling thread
+# and encoded and written by a background thread, at most queue_size of them waiting at once (write() blocks
+# when the writer falls that far behind). An error in the writer is raised by the next write() or close().
+class OverlayWriter:
+
+    def __init__(self, directory, queue_size=16, extension=".png"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.extension = extension
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="overlay-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, count, prob_map, path):
+        self.check()
+        with metrics.span("overlay", frame=count):
+            image = render_overlay(prob_map, path)
+        self.queue.put((count, image))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+
+            count, image = item
+            fname = os.path.join(self.directory, f"frame_{count:04d}{self.extension}")
+            try:
+                if not cv2.imwrite(fname, image):
+                    raise OSError(f"Could not write {fname}")
+            except Exception as e:
+                self.error = e
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # Waits for every queued frame to be written
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Shows the overlay of every frame in an OpenCV window as the frames come, without waiting for a key
+class OverlayWindow:
+
+    def __init__(self, name="segmentation", scale=2):
+        self.name = name
+        self.scale = scale
+
+    def write(self, count, prob_map, path):
+        with metrics.span("overlay", frame=count):
+            image = render_overlay(prob_map, path)
+        cv2.imshow(self.name, cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST))
+        cv2.waitKey(1)
+
+    def close(self):
+        cv2.destroyWindow(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
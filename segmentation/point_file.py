@@ -0,0 +1,144 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Binary point files (.pts) for the segmented points, written by singleprobjump.py and read by the registration.
+A 64 byte header followed by one 16 byte record per point: x, y, z as float32 (row and column in the image,
+z along the sweep) and the frame number as int32. Frames are appended as they are segmented and the point count
+in the header is only updated after their records are written, so a file cut short by a crash still holds
+every frame up to the last update. Reading memory maps the records, there is nothing to parse.
+
+Convert an old csv (one row per axis, or one x,y,z point per line): python point_file.py in.csv out.pts
+The csv files singleprobjump.py writes start with an "x,y,z" header line, which tells their layout apart from a
+MATLAB file with one row per axis (a headerless file of exactly 3 points would read the same either way).
+"""
+
+import argparse
+import os
+import struct
+import numpy as np
+
+MAGIC = b"USPOINTS"
+VERSION = 1
+HEADER_SIZE = 64
+# magic, version, header size, number of points, z spacing between frames (NaN when z is not the frame number
+# times a spacing, e.g. when it comes from the frame times and the probe speed)
+HEADER = struct.Struct("<8sIIQd")
+COUNT_OFFSET = 16
+
+RECORD = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("frame", "<i4")])
+
+# first line of a csv with one x,y,z point per line
+CSV_HEADER = "x,y,z"
+
+
+# Appends frames of points to a .pts file, creating it (or overwriting it unless append is set) first
+class PointWriter:
+
+    def __init__(self, path, spacing=0.2, append=False):
+        if append and os.path.exists(path):
+            self.file = open(path, "r+b")
+            self.count, self.spacing = read_header(self.file)
+        else:
+            self.file = open(path, "w+b")
+            self.count, self.spacing = 0, spacing
+            self.file.write(HEADER.pack(MAGIC, VERSION, HEADER_SIZE, 0, spacing).ljust(HEADER_SIZE, b"\0"))
+
+    # points is (n, 3) x, y, z, all of them from the given frame
+    def append(self, points, frame):
+        points = np.asarray(points).reshape(-1, 3)
+        records = np.empty(len(points), dtype=RECORD)
+        records["x"], records["y"], records["z"] = points.T
+        records["frame"] = frame
+
+        self.file.seek(HEADER_SIZE + self.count * RECORD.itemsize)
+        self.file.write(records.tobytes())
+        self.count += len(points)
+
+    # Makes the appended frames part of the file
+    def flush(self):
+        self.file.flush()
+        self.file.seek(COUNT_OFFSET)
+        self.file.write(struct.pack("<Q", self.count))
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Returns the number of points and the z spacing of an open .pts file
+def read_header(f):
+    f.seek(0)
+    magic, version, header_size, count, spacing = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{getattr(f, 'name', f)} is not a point file")
+    if version != VERSION or header_size != HEADER_SIZE:
+        raise ValueError(f"{getattr(f, 'name', f)} has point file version {version}, only {VERSION} is supported")
+
+    return count, spacing
+
+
+# Memory maps the records of a .pts file (read only), use ["x"], ["y"], ["z"] and ["frame"] for the fields
+def read_points(path):
+    with open(path, "rb") as f:
+        count, spacing = read_header(f)
+
+    if count == 0:
+        return np.empty(0, dtype=RECORD)
+
+    return np.memmap(path, dtype=RECORD, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+# Reads a csv of segmented points as a (3, n) array of x, y, z. A file starting with the CSV_HEADER line has
+# one point per line. Headerless files are told apart by their shape: 3 rows is one row per axis (the MATLAB
+# raw_segmented_points.csv), anything else one point per line.
+def read_csv_points(path):
+    import pandas as pd
+
+    with open(path) as f:
+        first = f.readline()
+    if first.replace(" ", "").strip() == CSV_HEADER:
+        return np.array(pd.read_csv(path), dtype=np.float64).reshape(-1, 3).T.copy()
+
+    raw = np.array(pd.read_csv(path, header=None), dtype=np.float64)
+    if raw.shape[0] != 3:
+        raw = raw.T.copy()
+
+    return raw
+
+
+# Converts a csv of segmented points (either layout, see read_csv_points) into a .pts file.
+# The frame of a point is its z over the spacing.
+def convert_csv(csv_path, pts_path, spacing=0.2):
+    raw = read_csv_points(csv_path)
+
+    frames = np.rint(raw[2] / spacing).astype(np.int32)
+    order = np.argsort(frames, kind="stable")
+    raw, frames = raw[:, order], frames[order]
+
+    with PointWriter(pts_path, spacing) as writer:
+        starts = np.flatnonzero(np.diff(frames, prepend=frames[:1] - 1))
+        for start, end in zip(starts, np.append(starts[1:], len(frames))):
+            writer.append(raw[:, start:end].T, frames[start])
+
+    return writer.count
+
+
+# Command line entry point (ultrasound-points), argv defaults to sys.argv[1:]
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Converts a segmented points csv into a binary point file")
+    parser.add_argument("csv", help="segmented points csv")
+    parser.add_argument("pts", help="point file to write")
+    parser.add_argument("--spacing", type=float, default=0.2, help="z spacing between frames")
+    args = parser.parse_args(argv)
+    print(f"Wrote {convert_csv(args.csv, args.pts, args.spacing)} points to {args.pts}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -3,94 +3,34 @@ Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
 This program performs image processing to obtain multiple segments of a patient's spine.
 Input: Ultrasound scans of the patient's back (in png format)
 Output: 1. Processed Spine Images
-        2. A csv file that will be fed into registration.py
+        2. A csv file (an x,y,z header, then one point per line) or a binary .pts point file that will be fed into registration.py
 """
 
 # Import Packages
-import os
-import cv2
-import glob
+# Only numpy and OpenCV are imported up front, the plotting and skimage are imported by the code that uses them
+import argparse
+import collections
+import contextlib
+import functools
+import logging
 import math
-import pandas as pd
 import cv2
 import numpy as np
-import scipy.ndimage
-import statistics
-from skimage import data, color
-import matplotlib.pyplot as plt
-from skimage.color import rgb2gray
-from skimage.transform import rescale, resize, downscale_local_mean
 from timeit import default_timer as timer
-import sys
-from skimage.io import imread
-
-
-# Python Migration of "find_best_path_jumping.m" of MATLAB
-# Applies Dynamic Programming to calculate the path of least cost.
-def find_best_path_jumping(curr):
-    x = 151  # these are hardcoded - should be determined instead.
-    y = 289
-
-    # if at end
-    if curr[1] == y:
-        curr_cost = 0
-        cost[int(curr[0]), int(curr[1])] = curr_cost  # Casted into int to access array index
-        nexts[int(curr[0]), int(curr[1])] = 0
-        return
-
-    max_jump = 50
-    no_cells = max_jump * 2 + 1
-
-    min_next = [0, 0]
-    min_cost = math.inf  # inf gives the largest num in float
-    # print(curr)
-    # print(int(curr[0]))
-
-    # calc costs
-    for i in range(no_cells):
-
-        # cell no
-        next = [0, 0]
-        next[0] = curr[0] + i - max_jump - 1
-        next[1] = curr[1] + 1
-        # print(next)
-
-        # out of bounds
-        if next[0] < 1 or next[0] > x:
-            next_cost = math.inf
-
-        # already calculated
-        elif cost[int(next[0]), int(next[1])] != math.inf:
-            next_cost = cost[int(next[0]), int(next[1])]
-
-        # need to recursively calculate
-        else:
-            next_cost = find_best_path_jumping(next)
-
-        # print(next_cost)
-        # add penalty if needed
-        if abs(curr[0] - next[0]) > 2:
-            if next_cost == None:
-                next_cost = 0
-            next_cost = next_cost + 0.2
-
-        # calculate running min
-        if next_cost != None and next_cost < min_cost:
-            min_cost = next_cost
-            min_next = next[0]
+from concurrent.futures import ProcessPoolExecutor
+from .get_prob_map_v2 import get_shadow_map, ProbMapEngine
+from .find_best_path_jumping import find_best_path_jumping, MultiScalePathFinder, PathFinder, PathTracker
+from .point_file import CSV_HEADER, PointWriter
+from .frame_source import FrameReader, ROI, SPACING, open_frames
+from .overlay import OverlayWindow, OverlayWriter
+from instrumentation import metrics
 
-    # set results
-
-    # print([int(curr[0]), int(curr[1])])
-    curr_cost = inv_prob[int(curr[0]), int(curr[1])] + min_cost
-    cost[int(curr[0]), int(curr[1])] = curr_cost
-    nexts[int(curr[0]), int(curr[1])] = min_next
-
-    return curr_cost
 
 # Python Migration of "get_prob_map.m" of MATLAB
 # Produces processed image in black and white
-def get_prob_map(grayscale):
+# shadow_fusion=False skips the acoustic shadow fusion and leaves only the intensity and gaussian terms
+def get_prob_map(grayscale, shadow_fusion=True):
+    from skimage.transform import rescale
 
     # Start prob map as simple intensity
     intensity_map = rescale(grayscale, .5, anti_aliasing=False)
@@ -110,111 +50,302 @@ def get_prob_map(grayscale):
     kernel1 = np.ones((3, 3), np.float32) / 9
     kernel1[1][1] = 0.8888889
 
-    y = 1
-    x = 1
-    shadow = np.ones((y, x)) * 0.2
-    overall_mean = np.mean(np.mean(intensity_map))
-
-    for i in range(1, x):
-        j = y
-        while (j > 0 and (
-                gausian[j, i] < overall_mean * 1.5 or np.mean(gausian[j - 10:j - 1, i]) < overall_mean * 1.5)):
-            shadow[j, i] = 0.1
-            j = j - 1
-        while (j > 0 and (gausian[j, i] > overall_mean * 1.5) or j > 5 and np.mean(
-                gausian[j - 5:j - 1, i]) > overall_mean * 1.5):
-            shadow[j, i] = intensity_map(j, i)
-            j = j - 1
-    shadow = cv2.GaussianBlur(shadow, (5, 5), 5)
-    prob_map = (shadow * prob_map) / (shadow * prob_map + (1 - shadow) * (1 - prob_map))
+    if shadow_fusion:
+        shadow = get_shadow_map(gausian, intensity_map)
+        shadow = cv2.GaussianBlur(shadow, (5, 5), 5)
+        prob_map = (shadow * prob_map) / (shadow * prob_map + (1 - shadow) * (1 - prob_map))
 
     return prob_map
 
-    k = cv2.waitKey(0) & 0xFF
-    if k == 27:  # wait for ESC key to exit
-        cv2.destroyAllWindows()
-    elif k == ord('s'):  # wait for 's' key to save and exit
-        cv2.imwrite('prob map of a single scan.png', prob_map)
-        cv2.destroyAllWindows()
 
-
-# Main File
-# Similar to single_line_path.m of MATLAB
-def main():
-
-    points = []
-    images = glob.glob('/Users/puaqieshang/Desktop/Taste of Research/MATLAB code/everything/phantom_images/phantom_3/scan_2/*.png')
-    images.sort()
-
-    count = 0
-    startTime = timer()
-    for fname in images:
-        print(f"Image No.{count+1}")
-        img = cv2.imread(fname)
-        # im = plt.imread(fname)
-        # implot = plt.imshow(im)
-        count = count + 1
-
-        us_img = img[80:400, 270:850]
-        gray = cv2.cvtColor(us_img, cv2.COLOR_BGR2GRAY)
-        # cv2.imshow('gray_image',gray)
-        # [x, y] = np.shape(gray)
-        # print(x)
-        # print(y)
-        prob_map = get_prob_map(gray)
-        highlyLikely = 0.05*np.max(prob_map)
-        np.savetxt("prob_map.csv", prob_map, delimiter=",")
-        # print(np.shape(prob_map))
-
-        """
-        Dynamic Programming Section
-        global variables are defined below
-        """
-        global inv_prob
-        inv_prob = 0.5 - prob_map
+# Points along each path that are highly likely to be bone, as [x, y, z] rows per frame.
+# prob_maps is (n_frames, rows, cols) and paths (n_frames, cols), z is the frame number times the 0.2 spacing,
+# or z[frame] if the z of every frame is given.
+def get_highly_likely_points(prob_maps, paths, first_frame=1, spacing=0.2, z=None):
+    prob_maps = np.asarray(prob_maps)
+    n_frames = np.shape(paths)[0]
+    cols = np.arange(np.shape(paths)[1])
+
+    on_path = prob_maps[np.arange(n_frames)[:, np.newaxis], paths, cols]
+    highly_likely = 0.05 * prob_maps.reshape(n_frames, -1).max(axis=1)
+    keep = on_path > highly_likely[:, np.newaxis]
+
+    point_sets = []
+    for frame in range(n_frames):
+        y = cols[keep[frame]]
+        x = paths[frame, y]
+        frame_z = (first_frame + frame) * spacing if z is None else z[frame]
+        point_sets.append(np.column_stack([x, y, np.full(len(y), frame_z)]))
+
+    return point_sets
+
+
+# Runs the DP and point extraction of main() on a whole stack of prob maps (n_frames, rows, cols) at once.
+# Pass the same PathFinder for every batch of a sweep so its buffers are reused.
+# Returns the paths (n_frames, cols) and the highly likely points of each frame.
+def segment_frames(prob_maps, first_frame=1, path_finder=None):
+    prob_maps = np.asarray(prob_maps)
+    if path_finder is None:
+        path_finder = PathFinder(max_jump=50, nexts=False)
+
+    cost, nexts, paths = path_finder(0.5 - prob_maps)
+    point_sets = get_highly_likely_points(prob_maps, paths, first_frame)
+
+    return paths, point_sets
+
+
+# Pipeline stages: scans -> grayscale ultrasound region -> prob map -> path -> points.
+# Each stage takes and yields (count, ...) tuples lazily, so a sweep only ever holds a frame at a time.
+# count is the 1 based frame number, the frame source turns it into the z coordinate of the points.
+# The scans are decoded to grayscale and cropped to roi (top, bottom, left, right) a few frames ahead on a thread
+# pool, roi=None detects the ultrasound region on the first scan instead of using the calibrated ROI.
+# Videos and image stacks have frame sources of their own (see open_frames in frame_source.py).
+def read_frames(images, first_frame=1, roi=ROI, prefetch=8):
+    yield from FrameReader(images, roi, first_frame, prefetch)
+
+
+# Uses the ProbMapEngine for the crop shape, so the prob map yielded is overwritten by the next frame.
+# full_resolution yields the prob map at the size of the crop instead of half of it.
+def compute_prob_maps(frames, full_resolution=False):
+    for count, gray in frames:
+        with metrics.span("prob_map", frame=count):
+            engine = prob_map_engine(np.shape(gray))
+            prob_map = engine(gray)
+            if full_resolution:
+                prob_map = engine.full_resolution()
+        yield count, prob_map
+
+
+# One ProbMapEngine per crop shape, shared by every frame this process handles
+@functools.lru_cache(maxsize=None)
+def prob_map_engine(shape):
+    return ProbMapEngine(shape)
+
+
+# With tracking the DP of every frame after the first only searches a band around the previous path.
+# Otherwise levels > 0 runs the full search on the prob map shrunk levels times by 2 and refines the path in a
+# corridor at every finer level (MultiScalePathFinder). The two do not go together.
+def find_paths(prob_maps, max_jump=50, tracking=False, levels=0):
+    if tracking and levels > 0:
+        raise ValueError("tracking searches a band around the previous path, it does not go with levels > 0")
+    tracker = PathTracker(max_jump=max_jump) if tracking else None
+    multi_scale = MultiScalePathFinder(levels, max_jump=max_jump) if levels > 0 else None
+    for count, prob_map in prob_maps:
         [a, b] = np.shape(prob_map)
-        start = [np.floor(a/2), 1]
-        global cost
-        cost = np.ones([a, b]) * np.Inf
-        global nexts
-        nexts = np.ones([a, b]) * -1
-        find_best_path_jumping(start)
-
-        # get points on this scan
-        point_scan = np.zeros([1, b])
-
-        implot = plt.imshow(prob_map)
-        # print(start[0])
-        curr_x = start[0]
-        for curr_y in range(b):
-            point_scan[0, curr_y] = curr_x
-
-            if prob_map[int(curr_x), int(curr_y)] > highlyLikely: #NEED TO CHANGE TO HIGHLY LIKELY!!!!!
-                # print("helloooooo")
-                # cv2.circle(gray, (int(curr_y), int(curr_x)), 1, (0, 0, 255), 1)
-                # append coloured points
-                plt.scatter(curr_x, curr_y, c='r', s=20)
-                coloured_pt = [curr_x, curr_y, count * 0.2]
-                # points = np.concatenate((points, coloured_pt), axis=1)
-                points.append(coloured_pt)
-
+        with metrics.span("dp", frame=count):
+            if tracker is not None:
+                cost, nexts, path = tracker(0.5 - prob_map, start_row=a // 2)
+            elif multi_scale is not None:
+                cost, nexts, path = multi_scale(0.5 - prob_map, start_row=a // 2)
             else:
-                # cv2.circle(gray, (int(curr_y), int(curr_x)), 1, (255, 0, 0), 1)
-                plt.scatter(curr_x, curr_y, c='b', s=20)
-
-            curr_x = nexts[int(curr_x), int(curr_y)]
-
-        plt.show()
-
-        endTime = timer()
-        # print(str(endTime - startTime) + " seconds")
-        print(f"The time taken is {endTime - startTime} seconds")
+                cost, nexts, path = find_best_path_jumping(0.5 - prob_map, max_jump=max_jump, start_row=a // 2,
+                                                           nexts=False)
+        yield count, prob_map, path
+
+
+# z gives the z coordinate of a frame from its count, the 0.2 spacing between frames if it is None.
+# scale is the size of the half size prob map over the size of these prob maps (0.5 for full resolution ones),
+# the points are always in the pixels of the half size prob map the registration is calibrated for.
+def extract_points(paths, z=None, scale=1):
+    for count, prob_map, path in paths:
+        with metrics.span("points", frame=count):
+            [frame_points] = get_highly_likely_points(prob_map[np.newaxis], path[np.newaxis], first_frame=count,
+                                                      z=None if z is None else [z(count)])
+            if scale != 1:
+                frame_points[:, :2] = (frame_points[:, :2] + 0.5) * scale - 0.5
+        metrics.count("points", len(frame_points))
+        yield count, prob_map, path, frame_points
+
+
+# Everything main() does to one decoded frame (grayscale ROI) at z, returns the path, the highly likely points
+# and, if asked for, the prob map
+def process_frame(gray, count, keep_prob_map=False, z=None, levels=0, full_resolution=False):
+    frames = [(count, gray)]
+    paths = find_paths(compute_prob_maps(frames, full_resolution), levels=levels)
+    [(count, prob_map, path, frame_points)] = extract_points(paths, None if z is None else lambda count: z,
+                                                             0.5 if full_resolution else 1)
+
+    prob_map = prob_map.copy() if keep_prob_map else None
+
+    return path, frame_points, prob_map
+
+
+# Each worker process already gets its own frames, so stop OpenCV from starting threads of its own
+def init_worker():
+    cv2.setNumThreads(1)
+
+
+# Runs the pipeline over a sorted list of scans or a frame source (open_frames), yielding (frame number, path,
+# points, prob map) in frame order. roi only applies to a list of scans, a frame source has its own.
+# The frames are always decoded in this process. With more than one worker the decoded frames are shared out to
+# a process pool. Only a few frames per worker are in flight at once so memory stays bounded, and the results
+# are identical to running on one core.
+# Tracking follows the path from frame to frame, so it needs the frames in order on one core, and it does not go
+# with levels > 0.
+# levels > 0 searches coarse to fine (see find_paths) and full_resolution refines the path on the full size crop,
+# the paths and prob maps are then full size too, the points stay in half size pixels.
+def segment_scan(images, workers=1, keep_prob_map=False, chunksize=4, tracking=False, roi=ROI, levels=0,
+                 full_resolution=False):
+    if tracking and workers != 1:
+        raise ValueError("tracking needs the frames in order, it can only run with one worker")
+    if tracking and levels > 0:
+        raise ValueError("tracking searches a band around the previous path, it does not go with levels > 0")
+
+    frames = images if hasattr(images, "z") else FrameReader(images, roi)
+
+    if workers == 1:
+        paths = find_paths(compute_prob_maps(frames, full_resolution), tracking=tracking, levels=levels)
+        for count, prob_map, path, frame_points in extract_points(paths, frames.z, 0.5 if full_resolution else 1):
+            yield count, path, frame_points, prob_map.copy() if keep_prob_map else None
+        return
 
-    np.savetxt("pls-work.csv", [*zip(*points)], delimiter=",") # Transpose points data and save into csv format
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        in_flight = collections.deque()
+        for count, gray in frames:
+            in_flight.append((count, pool.submit(process_frame, gray, count, keep_prob_map, frames.z(count), levels,
+                                                 full_resolution)))
+            if len(in_flight) >= workers * chunksize:
+                count, result = in_flight.popleft()
+                yield (count, *result.result())
+
+        while in_flight:
+            count, result = in_flight.popleft()
+            yield (count, *result.result())
+
+
+# Passes the segment_scan results straight through, appending the points of every frame to a csv file
+# (an x,y,z header line, then one point per line) as they go past, or to a binary point file if fname ends in .pts.
+# The file is flushed every chunk_frames frames, so a crash part way through a sweep only loses the frames
+# since the last flush. spacing is the z spacing between frames stored in a point file (NaN if z is not the frame
+# number times a spacing).
+def write_points(results, fname, chunk_frames=20, spacing=SPACING):
+    if fname.endswith(".pts"):
+        yield from write_point_file(results, fname, chunk_frames, spacing)
+        return
 
-    key = cv2.waitKey(0) & 0xFF
-    if key == ord("q"):
-        cv2.destroyAllWindows()
+    with open(fname, "w") as f:
+        f.write(CSV_HEADER + "\n")
+        pending = []
+        try:
+            for result in results:
+                count = result[0]
+                pending.append(result[2])
+                if len(pending) >= chunk_frames:
+                    with metrics.span("write", frame=count):
+                        np.savetxt(f, np.concatenate(pending), delimiter=",")
+                        f.flush()
+                    pending = []
+
+                yield result
+        finally:
+            if pending:
+                np.savetxt(f, np.concatenate(pending), delimiter=",")
+
+
+# write_points for .pts files, the frames are appended as they come and made visible every chunk_frames frames
+def write_point_file(results, fname, chunk_frames=20, spacing=SPACING):
+    with PointWriter(fname, spacing) as writer:
+        for written, result in enumerate(results, 1):
+            count = result[0]
+            with metrics.span("write", frame=count):
+                writer.append(result[2], count)
+                if written % chunk_frames == 0:
+                    writer.flush()
+
+            yield result
 
 
-main()
+# Main File
+# Similar to single_line_path.m of MATLAB
+# Runs headless unless asked for pictures: overlay_dir saves the prob map of every frame with its path drawn on
+# it (see overlay.py) and show shows them in a window as they come, neither waits for anything
+# workers > 1 processes the scans in parallel
+# tracking restricts the DP to a band around the previous frame's path (one core only, no pyramid)
+# show_metrics prints the time spent in every stage at the end, log_spans logs every stage of every frame and
+# profile_frame saves a cProfile of that frame to frame_<n>.prof (stages in worker processes are not measured)
+# output is the file the points are written to, a csv or a binary .pts point file
+# roi is the ultrasound region (top, bottom, left, right) of the scans, the one the registration is calibrated
+# for by default. None detects it on the first scan, which only suits scans exported differently from the phantom
+# ones and warns when the region found is not the calibrated one
+# source is the sweep: a folder or glob pattern of scans, a video or a multi-page image stack (see open_frames).
+# speed (mm/s) sets the z of every frame from its time instead of the frame number, frame_rate times the pages
+# of a stack
+# pyramid is the number of coarser levels of the coarse to fine path search (0 for the plain full search) and
+# full_resolution refines the path on the full size crop instead of the half size prob map (an approximation, see
+# ProbMapEngine.full_resolution), meant to go with pyramid > 0: warns without it
+def main(workers=1, tracking=False, show_metrics=False, log_spans=False, profile_frame=None, output="pls-work.csv",
+         roi=ROI, overlay_dir=None, show=False, source=None, speed=None, frame_rate=None, pyramid=0,
+         full_resolution=False):
+    registry = metrics.install(metrics.Registry()) if show_metrics else None
+    if log_spans:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        metrics.install(metrics.LogSink())
+    profiler = metrics.install(metrics.ProfileSink(profile_frame)) if profile_frame is not None else None
+
+    if source is None:
+        source = '/Users/puaqieshang/Desktop/Taste of Research/MATLAB code/everything/phantom_images/phantom_3/scan_2/*.png'
+    if full_resolution and pyramid == 0:
+        logging.getLogger(__name__).warning("--full-resolution without --pyramid runs the full path search on the "
+                                            "full size crop, about 2.5 times the cost, use --pyramid 2")
+    frames = open_frames(source, roi, speed=speed, frame_rate=frame_rate)
+    # with a speed z comes from the frame times, there is no spacing between frames
+    spacing = math.nan if getattr(frames, "speed", None) is not None else frames.spacing
+
+    with contextlib.ExitStack() as stack:
+        overlays = []
+        if overlay_dir is not None:
+            overlays.append(stack.enter_context(OverlayWriter(overlay_dir)))
+        if show:
+            overlays.append(stack.enter_context(OverlayWindow()))
+
+        startTime = timer()
+        results = write_points(segment_scan(frames, workers, keep_prob_map=bool(overlays), tracking=tracking,
+                                            roi=roi, levels=pyramid, full_resolution=full_resolution), output,
+                               spacing=spacing)
+        for count, path, frame_points, prob_map in results:
+            print(f"Image No.{count}")
+            for overlay in overlays:
+                overlay.write(count, prob_map, path)
+
+            endTime = timer()
+            print(f"The time taken is {endTime - startTime} seconds")
+
+    if registry is not None:
+        registry.print_summary()
+    if profiler is not None:
+        print(profiler.report(f"frame_{profile_frame}.prof"))
+
+
+# Command line entry point (ultrasound-segment), argv defaults to sys.argv[1:]
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Segments the bone surface in every scan of a sweep")
+    parser.add_argument("source", nargs="?", default=None,
+                        help="folder or glob pattern of scans, video file or multi-page image stack")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to share the scans between")
+    parser.add_argument("--tracking", action="store_true", help="search near the previous frame's path only")
+    parser.add_argument("--metrics", action="store_true", help="print the time spent in every stage at the end")
+    parser.add_argument("--log-spans", action="store_true", help="log the time of every stage of every frame")
+    parser.add_argument("--profile-frame", type=int, default=None, help="cProfile this frame (1 based)")
+    parser.add_argument("--output", default="pls-work.csv", help="points file, csv or binary .pts")
+    parser.add_argument("--roi", default=",".join(map(str, ROI)),
+                        help="ultrasound region as top,bottom,left,right (default: the calibrated one) or auto to "
+                             "detect it on the first scan")
+    parser.add_argument("--overlays", default=None, metavar="DIR", help="save every frame with its path drawn on it")
+    parser.add_argument("--show", action="store_true", help="show every frame with its path as it is segmented")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="probe speed (mm/s), z from the frame times instead of 0.2 mm per frame")
+    parser.add_argument("--frame-rate", type=float, default=None, help="frames per second of an image stack")
+    parser.add_argument("--pyramid", type=int, default=0, metavar="LEVELS",
+                        help="search the path on a prob map shrunk LEVELS times by 2, then refine it level by level")
+    parser.add_argument("--full-resolution", action="store_true",
+                        help="refine the path on the full size crop (best with --pyramid 2)")
+    args = parser.parse_args(argv)
+    roi = None if args.roi == "auto" else tuple(int(value) for value in args.roi.split(","))
+    main(workers=args.workers, tracking=args.tracking, show_metrics=args.metrics, log_spans=args.log_spans,
+         profile_frame=args.profile_frame, output=args.output, roi=roi, overlay_dir=args.overlays, show=args.show,
+         source=args.source, speed=args.speed, frame_rate=args.frame_rate, pyramid=args.pyramid,
+         full_resolution=args.full_resolution)
+
+
+if __name__ == "__main__":
+    cli()
@@ -3,7 +3,16 @@ from setuptools import setup
 setup(
     name='ultrasound_rego',
     version='1.0',
-    packages=[''],
+    packages=['instrumentation', 'segmentation', 'registration'],
+    python_requires='>=3.7',
+    entry_points={
+        'console_scripts': [
+            'ultrasound-segment = segmentation.singleprobjump:cli',
+            'ultrasound-points = segmentation.point_file:cli',
+            'ultrasound-register = registration.batch_registration:main',
+            'ultrasound-register-online = registration.online_registration:main',
+        ],
+    },
     url='https://github.com/puaqieshang/ultrasound-image-segmentation',
     license='University of New South Wales (UNSW), Australia',
     author='Qie Shang Pua, Rishav Raj',
@@ -0,0 +1,178 @@
+"""
+Created by: Rishav Raj and Qie Shang Pua, University of New South Wales
+Tests of the segmentation: the DP against a brute force reference, the ProbMapEngine against get_prob_map,
+segment_scan on one core against a process pool and the point files written and read back.
+Run from the repository root: python -m pytest -q
+"""
+
+import itertools
+import cv2
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import CROP_SHAPE, make_sweep
+from segmentation.find_best_path_jumping import (PathFinder, MultiScalePathFinder, find_best_path_banded,
+                                                 find_best_path_jumping)
+from segmentation.frame_source import ROI
+from segmentation.get_prob_map_v2 import ProbMapEngine
+from segmentation.point_file import PointWriter, convert_csv, read_csv_points, read_points
+from segmentation.singleprobjump import find_paths, get_prob_map, segment_scan, write_points
+from registration.calibration import load_raw_points
+
+
+# Cost map of the DP by trying every jump of every cell, and the cost of a path through inv_prob
+def brute_force_cost(inv_prob, max_jump, free_jump, penalty):
+    [a, b] = np.shape(inv_prob)
+    cost = np.empty([a, b])
+    cost[:, b - 1] = inv_prob[:, b - 1]
+    for col, row in itertools.product(range(b - 2, -1, -1), range(a)):
+        cost[row, col] = inv_prob[row, col] + min(
+            cost[next_row, col + 1] + (penalty if abs(next_row - row) > free_jump else 0)
+            for next_row in range(max(row - max_jump, 0), min(row + max_jump + 1, a)))
+
+    return cost
+
+
+def path_cost(inv_prob, path, free_jump, penalty):
+    jumps = np.abs(np.diff(path))
+    return inv_prob[path, np.arange(len(path))].sum() + penalty * np.count_nonzero(jumps > free_jump)
+
+
+# (max_jump, free_jump) pairs, including max_jump == free_jump and a max_jump wider than the map
+JUMPS = [(3, 1), (5, 2), (2, 2), (30, 2)]
+
+
+@pytest.mark.parametrize("max_jump, free_jump", JUMPS)
+def test_dp_matches_brute_force(max_jump, free_jump):
+    rng = np.random.default_rng(max_jump)
+    for repeat in range(5):
+        inv_prob = rng.random([12, 9]) - 0.5
+        start_row = int(rng.integers(12))
+        expected = brute_force_cost(inv_prob, max_jump, free_jump, 0.2)
+
+        cost, nexts, path = find_best_path_jumping(inv_prob, max_jump, start_row, free_jump)
+        np.testing.assert_allclose(cost, expected)
+        assert path[0] == start_row
+        assert np.all(np.abs(np.diff(path)) <= max_jump)
+        assert path_cost(inv_prob, path, free_jump, 0.2) == pytest.approx(expected[start_row, 0])
+
+
+# Integer maps are full of ties, the path without back pointers has to break them the same way
+@pytest.mark.parametrize("max_jump, free_jump", JUMPS)
+def test_dp_ties(max_jump, free_jump):
+    rng = np.random.default_rng(max_jump)
+    for repeat in range(5):
+        inv_prob = rng.integers(0, 3, [12, 9]).astype(np.float64)
+        cost, nexts, path = find_best_path_jumping(inv_prob, max_jump, 6, free_jump, penalty=1.0)
+        assert path_cost(inv_prob, path, free_jump, 1.0) == pytest.approx(cost[6, 0])
+
+        cost_only, no_nexts, same_path = find_best_path_jumping(inv_prob, max_jump, 6, free_jump, penalty=1.0,
+                                                                nexts=False)
+        assert no_nexts is None
+        np.testing.assert_array_equal(cost_only, cost)
+        np.testing.assert_array_equal(same_path, path)
+
+
+def test_batched_dp_matches_single_frames():
+    inv_prob = np.random.default_rng(1).random([4, 20, 15])
+    cost, nexts, paths = PathFinder(5)(inv_prob, start_row=10)
+    for frame in range(4):
+        expected_cost, expected_nexts, expected_path = find_best_path_jumping(inv_prob[frame], 5, 10)
+        np.testing.assert_array_equal(cost[frame], expected_cost)
+        np.testing.assert_array_equal(paths[frame], expected_path)
+
+
+def test_max_jump_below_free_jump():
+    with pytest.raises(ValueError):
+        PathFinder(max_jump=1, free_jump=2)
+
+
+# A band covering every row is the full search
+def test_banded_dp_with_the_whole_band():
+    rng = np.random.default_rng(2)
+    inv_prob = rng.random([10, 8])
+    prev_path = rng.integers(0, 10, 8)
+    cost, nexts, path = find_best_path_banded(inv_prob, prev_path, 10, max_jump=4)
+    expected_cost, expected_nexts, expected_path = find_best_path_jumping(inv_prob, 4, prev_path[0])
+    np.testing.assert_allclose(cost, expected_cost)
+    np.testing.assert_array_equal(path, expected_path)
+
+
+def test_multi_scale_dp_follows_the_surface():
+    [frame, surface] = next(make_sweep(1))
+    inv_prob = 0.5 - get_prob_map(frame)
+    [a, b] = np.shape(inv_prob)
+    cost, nexts, expected = find_best_path_jumping(inv_prob, start_row=a // 2)
+    for levels in [1, 2]:
+        assert MultiScalePathFinder(levels)(inv_prob, a // 2)[2] == pytest.approx(expected, abs=2)
+        cost, nexts, path = MultiScalePathFinder(levels, maps=True)(inv_prob, a // 2)
+        assert cost.shape == nexts.shape == (a, b)
+
+
+def test_prob_map_engine_matches_get_prob_map():
+    engine = ProbMapEngine(CROP_SHAPE)
+    for frame, surface in make_sweep(3):
+        for shadow_fusion in [True, False]:
+            np.testing.assert_allclose(engine(frame, shadow_fusion), get_prob_map(frame, shadow_fusion), atol=1e-6)
+
+
+def test_tracking_does_not_go_with_levels():
+    with pytest.raises(ValueError):
+        next(find_paths([], tracking=True, levels=1))
+
+
+@pytest.fixture
+def scans(tmp_path):
+    [top, bottom, left, right] = ROI
+    fnames = []
+    for count, (frame, surface) in enumerate(make_sweep(4), 1):
+        scan = np.zeros([bottom + 20, right + 20], dtype=np.uint8)
+        scan[top:bottom, left:right] = frame
+        fnames.append(str(tmp_path / f"scan_{count:03d}.png"))
+        cv2.imwrite(fnames[-1], scan)
+
+    return fnames
+
+
+def test_segment_scan_workers(scans):
+    one_core = list(segment_scan(scans, keep_prob_map=True))
+    two_workers = list(segment_scan(scans, workers=2, keep_prob_map=True))
+    assert [result[0] for result in one_core] == [1, 2, 3, 4]
+    for expected, result in zip(one_core, two_workers):
+        assert result[0] == expected[0]
+        for array, expected_array in zip(result[1:], expected[1:]):
+            np.testing.assert_array_equal(array, expected_array)
+
+
+def test_point_file_round_trip(tmp_path):
+    rng = np.random.default_rng(3)
+    frames = [rng.random([n, 3]).astype(np.float32) for n in [5, 0, 7]]
+    with PointWriter(tmp_path / "points.pts") as writer:
+        for frame, points in enumerate(frames, 1):
+            writer.append(points, frame)
+
+    records = read_points(tmp_path / "points.pts")
+    np.testing.assert_array_equal(np.stack([records["x"], records["y"], records["z"]], axis=1),
+                                  np.concatenate(frames))
+    np.testing.assert_array_equal(records["frame"], [1] * 5 + [3] * 7)
+    np.testing.assert_array_equal(load_raw_points(str(tmp_path / "points.pts")).T, np.concatenate(frames))
+
+
+# write_points for both formats, and the csv converted to .pts
+def test_written_points_round_trip(tmp_path):
+    rng = np.random.default_rng(4)
+    results = [(count, None, np.column_stack([rng.random([6, 2]) * 100, np.full(6, count * 0.2)]), None)
+               for count in range(1, 6)]
+    expected = np.concatenate([result[2] for result in results])
+
+    assert list(write_points(iter(results), str(tmp_path / "points.csv"), chunk_frames=2)) == results
+    np.testing.assert_allclose(read_csv_points(tmp_path / "points.csv"), expected.T)
+
+    assert len(list(write_points(iter(results), str(tmp_path / "points.pts"), chunk_frames=2))) == 5
+    records = read_points(tmp_path / "points.pts")
+    np.testing.assert_array_equal(records["frame"], np.repeat(np.arange(1, 6), 6))
+    np.testing.assert_allclose(load_raw_points(str(tmp_path / "points.pts")), expected.T, rtol=1e-6)
+
+    assert convert_csv(tmp_path / "points.csv", tmp_path / "converted.pts") == len(expected)
+    converted = read_points(tmp_path / "converted.pts")
+    np.testing.assert_array_equal(converted, records)